@@ -3,8 +3,10 @@ from .filesys import AirFileSystem
 from .filesys import FtpFileSystem
 from .filesys import LocalFileSystem
 from .snapshot import Snapshot
+from .snapshot import convert_snapshot
 from .snapshot import create_snapshot
 from .snapshot import merge_snapshot
 from .snapshot import rebuild_snapshot
 from .snapshot import sync_snapshot
 from .snapshot import update_snapshot
+from .snapshot import watch_snapshot
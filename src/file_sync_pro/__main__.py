@@ -12,6 +12,8 @@ cli.add_cmd(snapshot.update_snapshot)
 cli.add_cmd(snapshot.sync_snapshot)
 cli.add_cmd(snapshot.merge_snapshot)
 cli.add_cmd(snapshot.rebuild_snapshot)
+cli.add_cmd(snapshot.watch_snapshot)
+cli.add_cmd(snapshot.convert_snapshot)
 
 
 @cli
@@ -39,9 +41,22 @@ def force_sync_snapshot(snapshot_file_a: str, snapshot_file_b: str) -> None:
 def run_air_server() -> None:
     import lk_logger
     import os
+    from .filesys2 import bundle
+    from .filesys2 import delta
+    from .filesys2 import journal
     lk_logger.update(path_style='filename')
     air.register(filesys.LocalFileSystem)
-    air.run_server({'fs': lk_utils.fs, 'os': os}, port=2160, verbose=True)
+    air.run_server(
+        {
+            'bundle': bundle,
+            'delta': delta,
+            'fs': lk_utils.fs,
+            'journal': journal.server,
+            'os': os,
+        },
+        port=2160,
+        verbose=True,
+    )
 
 
 if __name__ == '__main__':
@@ -76,6 +91,15 @@ if __name__ == '__main__':
     pox -m file_sync_pro update_snapshot \
         data/snapshots/likianta-xiaomi-12s-pro/gitbook-source-docs.json
     
+    # keep snapshot updated in background (local root only)
+    pox -m file_sync_pro watch_snapshot \
+        data/snapshots/likianta-rider-r2/gitbook-source-docs.json
+    
+    # convert snapshot to compact binary format (or back to json)
+    pox -m file_sync_pro convert_snapshot \
+        data/snapshots/likianta-rider-r2/gitbook-source-docs.json \
+        data/snapshots/likianta-rider-r2/gitbook-source-docs.fsnap
+    
     # sync snapshot
     pox -m file_sync_pro sync_snapshot -h
     # dry run
@@ -1,6 +1,6 @@
 from argsense import cli
-from hashlib import md5
 from lk_utils import timestamp
+from .hash_cache import get_hash_cache
 from .snapshot import Snapshot
 
 
@@ -31,14 +31,24 @@ def fix_mtime(
     
     snap_data_a = snap_fulldata_a['current']['data']
     snap_data_b = snap_fulldata_b['current']['data']
+    stats_a = snap_fulldata_a['current'].get('stats', {})
+    stats_b = snap_fulldata_b['current'].get('stats', {})
     
     keys_a = frozenset(snap_data_a.keys())
     keys_b = frozenset(snap_data_b.keys())
     
-    def is_same_content(file_a, file_b) -> bool:
-        data_a: bytes = snap_a.fs.load(file_a, binary=True)
-        data_b: bytes = snap_b.fs.load(file_b, binary=True)
-        return md5(data_a).hexdigest() == md5(data_b).hexdigest()
+    hash_cache = get_hash_cache()
+    
+    def is_same_content(key, file_a, file_b) -> bool:
+        size_a = stats_a[key][0] if key in stats_a else -1
+        size_b = stats_b[key][0] if key in stats_b else -1
+        if size_a != -1 and size_b != -1 and size_a != size_b:
+            return False  # no need to hash if sizes differ.
+        return hash_cache.hash_file(
+            file_a, snap_data_a[key], size_a, snap_a.fs
+        ) == hash_cache.hash_file(
+            file_b, snap_data_b[key], size_b, snap_b.fs
+        )
     
     rows = [('index', 'key', 'mtime_a', '..', 'mtime_b')]
     rowx = 0
@@ -54,7 +64,9 @@ def fix_mtime(
         is_a_newer = mtime_a >= mtime_b
         file_a = '{}/{}'.format(root_a, key)
         file_b = '{}/{}'.format(root_b, key)
-        same = True if key.endswith('/') else is_same_content(file_a, file_b)
+        same = True if key.endswith('/') else is_same_content(
+            key, file_a, file_b
+        )
         
         if dry_run:
             rowx += 1
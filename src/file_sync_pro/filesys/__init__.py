@@ -3,5 +3,6 @@ from .air2 import is_local_path
 from .air2 import is_remote_path
 from .dufs import DufsFileSystem
 from .ftp import FtpFileSystem
+from .ftp_pool import PooledFtpFileSystem
 from .general import GeneralFileSystem
 from .local import LocalFileSystem
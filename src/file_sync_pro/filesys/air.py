@@ -1,11 +1,10 @@
 import airmise as air
 import json
-import os
 import typing as t
-from lk_utils import fs
 from .base import BaseFileSystem
 from .base import T
 from .local import LocalFileSystem
+from ..filesys2 import transfer
 
 
 # noinspection PyMethodMayBeStatic
@@ -64,6 +63,27 @@ class AirFileSystem(BaseFileSystem):
     def load(self, file: T.Path, *, binary: bool = False) -> t.Any:
         return self._fs.load(file, binary=binary)
     
+    def load_chunks(
+        self, file: T.Path, callback: t.Callable[[bytes], t.Any]
+    ) -> None:
+        """
+        like `load`, but pass each received chunk to `callback`, so the caller -
+        can decode the data while it is still downloading.
+        """
+        chunks = air.exec(
+            '''
+            def read():
+                with open(file, 'rb') as f:
+                    while chunk := f.read(size):
+                        yield chunk
+            return read()
+            ''',
+            file=file,
+            size=transfer.CHUNK_SIZE,
+        )
+        for chunk in transfer.prefetch(chunks):
+            callback(chunk)
+    
     def make_dir(self, dirpath: T.Path) -> None:
         self._fs.make_dir(dirpath)
     
@@ -83,10 +103,14 @@ class AirFileSystem(BaseFileSystem):
     # -------------------------------------------------------------------------
     
     def download_file(
-        self, file_i: T.Path, file_o: T.Path, mtime: T.Time = None
+        self,
+        file_i: T.Path,
+        file_o: T.Path,
+        mtime: T.Time = None,
+        compress: bool = False,
     ) -> None:
-        data = self._fs.load(file_i, binary=True)
-        fs.dump(data, file_o, 'binary')
+        # streamed in chunks, memory use doesn't grow with file size.
+        transfer.download(air.exec, file_i, file_o, mtime, compress=compress)
         
         # assert file_i.startswith('/storage/emulated/0/Likianta/')
         # url = 'http://{}:{}/{}'.format(
@@ -96,16 +120,16 @@ class AirFileSystem(BaseFileSystem):
         # )
         # data = requests.get(url).content
         # fs.dump(data, file_o, 'binary')
-        
-        if mtime is None:
-            mtime = air.exec('fs.filetime(file)', file=file_i)
-        os.utime(file_o, (mtime, mtime))
     
     def upload_file(
-        self, file_i: T.Path, file_o: T.Path, mtime: T.Time = None
+        self,
+        file_i: T.Path,
+        file_o: T.Path,
+        mtime: T.Time = None,
+        compress: bool = False,
     ) -> None:
-        data = fs.load(file_i, 'binary')
-        self._fs.dump(data, file_o, binary=True)
+        # streamed in chunks, the mtime is set along with the last chunk.
+        transfer.upload(air.exec, file_i, file_o, mtime, compress=compress)
         
         # assert file_o.startswith('/storage/emulated/0/Likianta/')
         # url = 'http://{}:{}/{}'.format(
@@ -114,15 +138,6 @@ class AirFileSystem(BaseFileSystem):
         #     file_o.replace('/storage/emulated/0/Likianta/', '', 1)
         # )
         # requests.put(url, fs.load(file_i, 'binary'))
-        
-        air.exec(
-            '''
-            import os
-            os.utime(file, (mtime, mtime))
-            ''',
-            file=file_o,
-            mtime=mtime or fs.filetime(file_i),
-        )
     
     def _serialize_data(self, data: t.Any) -> bytes:
         if isinstance(data, bytes):
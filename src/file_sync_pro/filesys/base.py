@@ -5,7 +5,8 @@ class T:
     Path = str
     RelPath = str
     Time = int
-    Ignores = t.FrozenSet[Path]
+    Ignores = t.Union[t.FrozenSet[Path], t.Tuple[Path, ...]]
+    #   ignore patterns, see `..filesys2.ignores`.
     Tree = t.Dict[RelPath, Time]
 
 
@@ -9,12 +9,22 @@ from datetime import datetime
 from lk_utils import fs
 from uuid import uuid1
 from .air import AirFileSystem
+from ..filesys2 import transfer
+from ..filesys2.ignores import make_matcher
 from .base import T
 
 
 class FtpFileSystem(AirFileSystem):
+    _temp_root = '/Likianta/documents/appdata/file-sync-pro/temp'
+    
     @classmethod
-    def create_from_url(cls, url: str) -> t.Tuple['FtpFileSystem', T.Path]:
+    def create_from_url(
+        cls, url: str, **kwargs
+    ) -> t.Tuple['FtpFileSystem', T.Path]:
+        """
+        kwargs: passed to the constructor, e.g. `connections` of -
+            `PooledFtpFileSystem`.
+        """
         a, b, c, d = (url + '/').split('/', 3)
         #   e.g. 'ftp://172.20.128.123:2161/Likianta/test/snapshot.json'
         #       a = 'ftp:'
@@ -23,7 +33,7 @@ class FtpFileSystem(AirFileSystem):
         #       d = 'Likianta/test/snapshot.json'
         assert a == 'ftp:' and b == '' and ':' in c
         e, f = c.split(':')
-        return FtpFileSystem(host=e, port=int(f)), '/' + d
+        return cls(host=e, port=int(f), **kwargs), '/' + d
     
     # noinspection PyMissingConstructor
     def __init__(self, host: str, port: int = 2162) -> None:
@@ -31,14 +41,26 @@ class FtpFileSystem(AirFileSystem):
         self._ftp = ftplib.FTP()
         self._ftp.connect(host, port)
         self._ftp.login()
+        self._mdtm_supported = None  # type: t.Optional[bool]
+        #   whether the server answers `MDTM` for hidden files. it is decided
+        #   by the first reply other than 550 (file not found): 500 or 502
+        #   means unsupported.
         self._time_shift = 8 * 3600  # we are living in utc8
         #   TODO: detect current timezone
     
+    def close(self) -> None:
+        try:
+            self._ftp.quit()
+        except (OSError, ftplib.Error):
+            self._ftp.close()
+    
     def download_file(
         self, file_i: T.Path, file_o: T.Path, mtime: T.Time = None
     ) -> None:
-        data = self.load(file_i)
-        fs.dump(data, file_o, 'binary')
+        # received blocks are written as they arrive, instead of being -
+        # collected in memory.
+        with open(file_o, 'wb') as f:
+            self._ftp.retrbinary(f'RETR {file_i}', f.write)
         if mtime is None:  # TODO
             # print(':v6p', 'please manually pass mtime of {}'.format(file_i))
             return
@@ -75,7 +97,7 @@ class FtpFileSystem(AirFileSystem):
         # path = self._normpath(path)
         a, b = path.rsplit('/', 1)
         if b[0] == '.':
-            for n, _ in self._find_hidden_names(a):
+            for n, *_ in self._find_hidden_names(a):
                 if n == b:
                     return True
         else:
@@ -85,30 +107,35 @@ class FtpFileSystem(AirFileSystem):
         return False
     
     def findall_files(
-        self, root: T.Path = None, ignores: T.Ignores = None  # TODO
+        self,
+        root: T.Path = None,
+        ignores: T.Ignores = None,
+        sizes: t.Dict[T.Path, int] = None,
     ) -> t.Iterator[t.Tuple[T.Path, T.Time]]:
-        def get_modify_time_of_hidden_file(file: T.Path) -> T.Time:
-            with self._temp_rename_file(file) as file_x:
-                a, b = fs.split(file_x)
-                for name, info in self._ftp.mlsd(a):
-                    if name == b:
-                        return self._time_str_2_int(
-                            info['modify'], shift=self._time_shift
-                        )
-                else:
-                    raise Exception(file)
-        
+        """
+        params:
+            ignores: ignore patterns relative to `root`, see -
+                `..filesys2.ignores`. ignored dirs are not descended.
+            sizes: if given, it will be filled with `{path: size}` of yielded -
+                files. a file is absent if the server doesn't report its size.
+        """
         hidden_files = []
-        for file, info in self._findall_files(root):
-            if info is None:
+        for file, info in self._findall_files(
+            root, _match=make_matcher(ignores or ())
+        ):
+            if sizes is not None and 'size' in info:
+                sizes[file] = int(info['size'])
+            if 'modify' not in info:
                 hidden_files.append(file)
             else:
                 yield file, self._time_str_2_int(
                     info['modify'], shift=self._time_shift
                 )
-        for file in hidden_files:
-            print(file, ':v6i')
-            yield file, get_modify_time_of_hidden_file(file)
+        if hidden_files:
+            print('resolve mtime of {} hidden files'.format(
+                len(hidden_files)
+            ), ':v6i')
+            yield from self._get_mtimes_of_hidden_files(hidden_files)
     
     def load(self, file: T.Path, **_) -> bytes:
         with io.BytesIO() as f:
@@ -116,6 +143,15 @@ class FtpFileSystem(AirFileSystem):
             f.seek(0)
             return f.read()
     
+    def load_chunks(
+        self, file: T.Path, callback: t.Callable[[bytes], t.Any]
+    ) -> None:
+        """
+        like `load`, but pass each received chunk to `callback`, so the caller -
+        can decode the data while it is still downloading.
+        """
+        self._ftp.retrbinary(f'RETR {file}', callback)
+    
     def make_dir(self, dirpath: T.Path) -> None:
         self.make_dirs(dirpath, precheck=False)
     
@@ -131,61 +167,182 @@ class FtpFileSystem(AirFileSystem):
     ) -> None:
         # this method similar to `self.dump`, but keeps origin file's modify -
         # time for target.
+        # the file is sent in blocks by `storbinary`, instead of being read -
+        # into memory at once.
+        if self.exist(file_o):
+            self._ftp.delete(file_o)  # see the note in `self.dump`.
         with open(file_i, 'rb') as f:
-            self.dump(f.read(), file_o)
+            self._ftp.storbinary(
+                f'STOR {file_o}', f, blocksize=transfer.CHUNK_SIZE
+            )
         if mtime is None:
             mtime = t.cast(int, fs.filetime(file_i))
         self._ftp.sendcmd('MFMT {} {}'.format(
             self._time_int_2_str(mtime, -self._time_shift), file_o
         ))
     
+    def _get_mtimes_of_hidden_files(
+        self, files: t.Sequence[T.Path], batch_size: int = 100
+    ) -> t.Iterator[t.Tuple[T.Path, T.Time]]:
+        """
+        hidden files are not listed by `MLSD`, so we need another way to get -
+        their mtimes:
+            1. `MDTM <file>`, nothing is touched. the commands are sent in -
+                batches (see `_send_batch`), one round trip per batch.
+            2. if the server doesn't support (1), move a batch of files into -
+                the temp dir with non-hidden names, `MLSD` the temp dir once, -
+                and move them back. the renames are batched too.
+        a file which is gone meanwhile (550) is skipped.
+        """
+        files = list(files)
+        # the first reply tells whether `MDTM` is supported.
+        while files and self._mdtm_supported is None:
+            try:
+                resp = self._ftp.sendcmd('MDTM {}'.format(files[0]))
+            except ftplib.error_perm as e:
+                if _reply_code(e) in ('500', '502'):
+                    self._mdtm_supported = False
+                    break
+                if _reply_code(e) != '550':
+                    raise
+                print(':v6', 'skip missing file: {}'.format(files.pop(0)))
+                continue
+            self._mdtm_supported = True
+            yield files.pop(0), self._mdtm_2_int(resp)
+        
+        if self._mdtm_supported:
+            for j in range(0, len(files), batch_size):
+                batch = files[j:j + batch_size]
+                for file, resp in zip(batch, self._send_batch(
+                    ['MDTM {}'.format(x) for x in batch]
+                )):
+                    if isinstance(resp, ftplib.Error):
+                        if _reply_code(resp) != '550':
+                            raise resp
+                        print(':v6', 'skip missing file: {}'.format(file))
+                    else:
+                        yield file, self._mdtm_2_int(resp)
+            return
+        
+        for j in range(0, len(files), batch_size):
+            batch = {
+                '_temp_file_{}'.format(uuid1().hex): file
+                for file in files[j:j + batch_size]
+            }
+            replies = self._send_batch([
+                cmd
+                for name, file in batch.items()
+                for cmd in (
+                    'RNFR {}'.format(file),
+                    'RNTO {}/{}'.format(self._temp_root, name),
+                )
+            ])
+            moved = {}  # {temp_name: file, ...}
+            for (name, file), resp in zip(batch.items(), replies[1::2]):
+                if isinstance(resp, ftplib.Error):
+                    print(':v6', 'skip missing file: {}'.format(file))
+                else:
+                    moved[name] = file
+            try:
+                mtimes = {
+                    name: info['modify']
+                    for name, info in self._ftp.mlsd(self._temp_root)
+                    if name in moved
+                }
+            finally:
+                replies = self._send_batch([
+                    cmd
+                    for name, file in moved.items()
+                    for cmd in (
+                        'RNFR {}/{}'.format(self._temp_root, name),
+                        'RNTO {}'.format(file),
+                    )
+                ])
+                if failed := [
+                    file
+                    for file, resp in zip(moved.values(), replies[1::2])
+                    if isinstance(resp, ftplib.Error)
+                ]:
+                    raise Exception(
+                        'cannot move back from temp dir', self._temp_root,
+                        failed
+                    )
+            for name, file in moved.items():
+                yield file, self._time_str_2_int(
+                    mtimes[name], shift=self._time_shift
+                )
+    
+    def _mdtm_2_int(self, resp: str) -> T.Time:
+        """
+        resp: e.g. '213 20250619064438' or '213 20250619064438.504'
+        """
+        return self._time_str_2_int(
+            resp.split(' ', 1)[1].strip(), shift=self._time_shift
+        )
+    
+    def _send_batch(
+        self, cmds: t.Sequence[str]
+    ) -> t.List[t.Union[str, ftplib.Error]]:
+        """
+        send all commands before reading any reply (pipelining), so a batch -
+        costs one round trip instead of one per command. the replies are -
+        read in order, failed ones included, to keep the control connection -
+        in sync.
+        returns: a reply string, or the error raised for it, per command.
+        """
+        for cmd in cmds:
+            self._ftp.putcmd(cmd)
+        out = []
+        for _ in cmds:
+            try:
+                out.append(self._ftp.getresp())
+            except ftplib.Error as e:
+                out.append(e)
+        return out
+    
     # noinspection PyTypeChecker
-    def _find_hidden_names(self, dir: T.Path) -> t.Iterator[
-        t.Tuple[str, t.Literal['dir', 'file']]
-    ]:
+    def _find_hidden_names(
+        self, dir: T.Path, ftp: ftplib.FTP = None
+    ) -> t.Iterator[t.Tuple[str, t.Literal['dir', 'file'], int]]:
+        """
+        yields: ((name, type, size), ...)
+        """
         ls: t.List[str] = []
-        self._ftp.retrlines('LIST -a {}'.format(dir), ls.append)
+        (ftp or self._ftp).retrlines('LIST -a {}'.format(dir), ls.append)
         pattern = re.compile(
             r'([-d])rwx?-+ +'
             r'0 user group +'
-            r'\d+ '  # size
+            r'(\d+) '  # size
             r'\w+ +\d+ +(?:\d\d:\d\d|\d{4}) '  # time
             r'(.+)'  # name
         )
         for line in ls:
             assert (m := pattern.match(line)), line
-            a, b = m.groups()
+            a, size, b = m.groups()
             if b[0] == '.':
-                yield b, 'dir' if a == 'd' else 'file'
+                yield b, 'dir' if a == 'd' else 'file', int(size)
     
     def _findall_files(
-        self, root: T.Path, _outward_path: T.Path = None
-    ) -> t.Iterator[t.Tuple[T.Path, t.Optional[dict]]]:
+        self,
+        root: T.Path,
+        _outward_path: T.Path = None,
+        _match: t.Optional[t.Callable[[str], t.Any]] = None,
+        _relprefix: str = '',
+    ) -> t.Iterator[t.Tuple[T.Path, dict]]:
         """
-        yields: ((file, info | None), ...)
+        yields: ((file, info), ...)
             field: absolute path
-            info: {'time': str, ...}
+            info: {'modify': str, 'size': str, ...}
                 time for example: '20250619064438.504'
                 be noticed the time is in utc0 format!
+                hidden files are not listed by `MLSD`, their info has only -
+                'size' (int) from `LIST -a`.
         """
         assert root.startswith('/') and '[' not in root and ']' not in root
         
-        files = []
-        subdirs = []
-        
-        for name, info in self._ftp.mlsd(root):
-            if info['type'] == 'file':
-                files.append((name, info))
-            elif info['type'] == 'dir':
-                subdirs.append(name)
-            else:
-                raise Exception((_outward_path, root), name, info)
-        
-        for name, type in self._find_hidden_names(root):
-            if type == 'file':
-                files.append((name, None))
-            else:
-                subdirs.append(name)
+        files, subdirs = self._list_dir(
+            root, _match=_match, _relprefix=_relprefix
+        )
         
         for name, info in sorted(files, key=lambda x: x[0]):
             yield f'{_outward_path or root}/{name}', info
@@ -196,14 +353,56 @@ class FtpFileSystem(AirFileSystem):
                 with self._temp_rename_dir(f'{root}/{name}') as temp_dir:
                     yield from self._findall_files(
                         root=temp_dir,
-                        _outward_path=f'{_outward_path or root}/{name}'
+                        _outward_path=f'{_outward_path or root}/{name}',
+                        _match=_match,
+                        _relprefix=f'{_relprefix}{name}/',
                     )
             else:
                 yield from self._findall_files(
                     root=f'{root}/{name}',
-                    _outward_path=f'{_outward_path or root}/{name}'
+                    _outward_path=f'{_outward_path or root}/{name}',
+                    _match=_match,
+                    _relprefix=f'{_relprefix}{name}/',
                 )
     
+    def _list_dir(
+        self,
+        dir: T.Path,
+        ftp: ftplib.FTP = None,
+        _match: t.Optional[t.Callable[[str], t.Any]] = None,
+        _relprefix: str = '',
+    ) -> t.Tuple[t.List[t.Tuple[str, dict]], t.List[str]]:
+        """
+        returns: (files, subdirs)
+            files: [(name, info), ...]
+                info of hidden files has only 'size', see `_findall_files`.
+            subdirs: [name, ...]
+        """
+        ftp = ftp or self._ftp
+        files = []
+        subdirs = []
+        
+        for name, info in ftp.mlsd(dir):
+            if info['type'] == 'file':
+                files.append((name, info))
+            elif info['type'] == 'dir':
+                subdirs.append(name)
+            else:
+                raise Exception(dir, name, info)
+        
+        for name, type, size in self._find_hidden_names(dir, ftp):
+            if type == 'file':
+                files.append((name, {'size': size}))
+            else:
+                subdirs.append(name)
+        
+        if _match:
+            files = [x for x in files if not _match(_relprefix + x[0])]
+            subdirs = [
+                x for x in subdirs if not _match(_relprefix + x + '/')
+            ]
+        return files, subdirs
+    
     # @staticmethod
     # def _is_hidden_file(path: T.Path) -> bool:
     #     return path.rsplit('/', 1)[-1][0] == '.'
@@ -230,10 +429,7 @@ class FtpFileSystem(AirFileSystem):
         self, a: T.Path, b: T.Path = None
     ) -> t.Iterator[T.Path]:
         if b is None:
-            b = (
-                '/Likianta/documents/appdata/file-sync-pro/temp/'
-                '._temp_dir_{}'.format(uuid1().hex)
-            )
+            b = '{}/._temp_dir_{}'.format(self._temp_root, uuid1().hex)
         with self._temp_rename(a, b) as x:
             yield x
     
@@ -242,10 +438,7 @@ class FtpFileSystem(AirFileSystem):
         self, a: T.Path, b: T.Path = None
     ) -> t.Iterator[T.Path]:
         if b is None:
-            b = (
-                '/Likianta/documents/appdata/file-sync-pro/temp/'
-                '_temp_file_{}'.format(uuid1().hex)
-            )
+            b = '{}/_temp_file_{}'.format(self._temp_root, uuid1().hex)
         with self._temp_rename(a, b) as x:
             yield x
     
@@ -275,3 +468,7 @@ class FtpFileSystem(AirFileSystem):
 def send_file_to_remote(file_i: T.Path, file_o: T.Path) -> None:
     fs, file_o = FtpFileSystem.create_from_url(file_o)
     fs.upload_file(file_i, file_o)
+
+
+def _reply_code(e: ftplib.Error) -> str:
+    return str(e)[:3]
@@ -0,0 +1,113 @@
+import ftplib
+import queue
+import typing as t
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
+from .base import T
+from .ftp import FtpFileSystem
+
+
+class PooledFtpFileSystem(FtpFileSystem):
+    """
+    the same as `FtpFileSystem`, but lists directories concurrently over -
+    multiple logged-in connections. listing a directory-heavy tree is latency -
+    bound, so it scales almost linearly with the number of connections.
+    
+    the main connection (`self._ftp`) is still used for all other operations. -
+    the extra connections are opened on the first listing, and closed by -
+    `close`.
+    """
+    
+    def __init__(
+        self, host: str, port: int = 2162, connections: int = 4
+    ) -> None:
+        super().__init__(host, port)
+        self._connections = connections
+        self._host = host
+        self._opened: t.List[ftplib.FTP] = []
+        self._pool: queue.Queue[ftplib.FTP] = queue.Queue()
+        self._port = port
+    
+    def close(self) -> None:
+        for ftp in self._opened:
+            try:
+                ftp.quit()
+            except (OSError, ftplib.Error):
+                ftp.close()
+        self._opened.clear()
+        self._pool = queue.Queue()
+        super().close()
+    
+    @contextmanager
+    def _borrow(self) -> t.Iterator[ftplib.FTP]:
+        ftp = self._pool.get()
+        try:
+            yield ftp
+        finally:
+            self._pool.put(ftp)
+    
+    def _open_pool(self) -> None:
+        while len(self._opened) < self._connections:
+            ftp = ftplib.FTP()
+            ftp.connect(self._host, self._port)
+            ftp.login()
+            self._opened.append(ftp)
+            self._pool.put(ftp)
+    
+    def _findall_files(
+        self,
+        root: T.Path,
+        _outward_path: T.Path = None,
+        _match: t.Optional[t.Callable[[str], t.Any]] = None,
+        _relprefix: str = '',
+    ) -> t.Iterator[t.Tuple[T.Path, dict]]:
+        """
+        yields the same items as `FtpFileSystem._findall_files`, but in the -
+        order of listing completion.
+        
+        dirs with "[" or "]" in name must be temporarily renamed to be listed, -
+        they are walked at last on the main connection, in serial.
+        """
+        assert root.startswith('/') and '[' not in root and ']' not in root
+        self._open_pool()
+        outward = _outward_path or root
+        bracketed = []
+        
+        def list_dir(dir: T.Path, relprefix: str) -> t.Tuple[
+            T.Path, str, t.List[t.Tuple[str, dict]], t.List[str]
+        ]:
+            with self._borrow() as ftp:
+                files, subdirs = self._list_dir(dir, ftp, _match, relprefix)
+            return dir, relprefix, files, subdirs
+        
+        with ThreadPoolExecutor(self._connections) as pool:
+            pending = {pool.submit(list_dir, root, _relprefix)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir, relprefix, files, subdirs = future.result()
+                    outward_dir = outward + dir[len(root):]
+                    for name, info in sorted(files, key=lambda x: x[0]):
+                        yield f'{outward_dir}/{name}', info
+                    for name in sorted(subdirs):
+                        if '[' in name or ']' in name:
+                            bracketed.append((
+                                f'{dir}/{name}',
+                                f'{outward_dir}/{name}',
+                                f'{relprefix}{name}/',
+                            ))
+                        else:
+                            pending.add(pool.submit(
+                                list_dir, f'{dir}/{name}', f'{relprefix}{name}/'
+                            ))
+        
+        for dir, outward_dir, relprefix in bracketed:
+            with self._temp_rename_dir(dir) as temp_dir:
+                yield from super()._findall_files(
+                    root=temp_dir,
+                    _outward_path=outward_dir,
+                    _match=_match,
+                    _relprefix=relprefix,
+                )
@@ -0,0 +1,108 @@
+"""
+send many small files in one round trip.
+
+a bundle is a list of `(relpath, mtime, data, is_compressed)`, bounded by -
+`MAX_COUNT` and `MAX_BYTES` (before compression). the receiver creates parent -
+dirs, writes the files and restores their mtimes in one call (`unpack`), -
+instead of the exist + make_dirs + dump + utime round trips per file.
+
+the air server exposes this module as `bundle` (see -
+`file_sync_pro.__main__ : run_air_server`).
+"""
+
+import os
+import typing as t
+from . import compress as compress_
+
+
+class T:
+    Exec = t.Callable[..., t.Any]  # see `transfer.T.Exec`
+    Path = str
+    RelPath = str
+    Time = int
+    Bundle = t.List[t.Tuple[RelPath, Time, bytes, bool]]
+
+
+MAX_BYTES = 4 * 1024 * 1024
+MAX_COUNT = 1000
+
+
+# -----------------------------------------------------------------------------
+# both sides
+
+
+def pack(
+    root: T.Path, relpaths: t.Iterable[T.RelPath], compress: bool = False
+) -> T.Bundle:
+    """
+    params:
+        compress: compress each file if worthwhile, see `compress.py`.
+    """
+    out = []
+    for relpath in relpaths:
+        path = '{}/{}'.format(root, relpath)
+        with open(path, 'rb') as f:
+            data = f.read()
+        z = compress and compress_.by_name(path) and compress_.probe(data)
+        out.append((
+            relpath,
+            int(os.path.getmtime(path)),
+            compress_.compress(data) if z else data,
+            z,
+        ))
+    return out
+
+
+def unpack(root: T.Path, items: T.Bundle) -> None:
+    made = set()
+    for relpath, mtime, data, z in items:
+        path = '{}/{}'.format(root, relpath)
+        if (d := os.path.dirname(path)) not in made:
+            os.makedirs(d, exist_ok=True)
+            made.add(d)
+        with open(path, 'wb') as f:
+            f.write(compress_.decompress(data) if z else data)
+        os.utime(path, (mtime, mtime))
+
+
+# -----------------------------------------------------------------------------
+# client side
+
+
+def upload(
+    exec_: T.Exec,
+    root_i: T.Path,
+    root_o: T.Path,
+    relpaths: t.Sequence[T.RelPath],
+    compress: bool = False,
+) -> None:
+    """
+    params:
+        root_i: local root.
+        root_o: remote root.
+    """
+    exec_(
+        'bundle.unpack(root, items)',
+        root=root_o,
+        items=pack(root_i, relpaths, compress),
+    )
+
+
+def download(
+    exec_: T.Exec,
+    root_i: T.Path,
+    root_o: T.Path,
+    relpaths: t.Sequence[T.RelPath],
+    compress: bool = False,
+) -> None:
+    """
+    params:
+        root_i: remote root.
+        root_o: local root.
+    """
+    unpack(root_o, exec_(
+        'return bundle.pack(root, relpaths, compress)',
+        root=root_i,
+        relpaths=relpaths,
+        compress=compress,
+    ))
@@ -0,0 +1,59 @@
+"""
+adaptive on-the-wire compression for transfers.
+
+a file is compressed with zlib at level 1 (fast, and available on both ends -
+without extra packages), unless:
+    - its extension is of an already-compressed format (jpg, mp4, zip...), or
+    - a probe on its first `PROBE_SIZE` bytes shrinks less than -
+      `PROBE_RATIO`, i.e. the data is near random (high entropy).
+
+streamed files are compressed chunk by chunk, each chunk independently, so -
+the receiver can decompress a chunk without any state from the previous -
+call.
+"""
+
+import os
+import zlib
+
+
+LEVEL = 1
+PROBE_SIZE = 64 * 1024
+PROBE_RATIO = 0.9
+
+SKIP_EXTS = frozenset((
+    # images
+    '.avif', '.gif', '.heic', '.jpeg', '.jpg', '.png', '.webp',
+    # audio and video
+    '.aac', '.avi', '.flac', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg',
+    '.opus', '.webm',
+    # archives and packages
+    '.7z', '.apk', '.br', '.bz2', '.gz', '.jar', '.lz4', '.rar', '.xz', '.zip',
+    '.zst',
+    # zipped documents and fonts
+    '.docx', '.epub', '.pdf', '.pptx', '.woff2', '.xlsx',
+))
+
+
+def by_name(path: str) -> bool:
+    """
+    return false if the file is of an already-compressed format.
+    """
+    return os.path.splitext(path)[1].lower() not in SKIP_EXTS
+
+
+def probe(data: bytes) -> bool:
+    """
+    return true if `data` is worth compressing.
+    """
+    sample = data[:PROBE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, LEVEL)) < len(sample) * PROBE_RATIO
+
+
+def compress(data: bytes) -> bytes:
+    return zlib.compress(data, LEVEL)
+
+
+def decompress(data: bytes) -> bytes:
+    return zlib.decompress(data)
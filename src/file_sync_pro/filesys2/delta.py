@@ -0,0 +1,396 @@
+"""
+rsync-style delta transfer, for overwriting a file whose old version exists -
+on the receiving side.
+
+1. the receiver splits its old copy into blocks, and sends back a weak -
+   (adler32) and a strong (md5) checksum of each block.
+2. the sender scans its new file with a window of one block. if the window -
+   matches a block of the old copy (weak checksum first, then the strong -
+   one), a block reference is emitted and the window jumps a whole block. -
+   otherwise the window moves one byte on, and the byte leaves into a -
+   literal range.
+   literal ranges are compressed if worthwhile (see `compress.py`), each -
+   with its own flag, since edits in a text file are what compresses well.
+3. the receiver rebuilds the file from literal ranges and blocks of its old -
+   copy into a temp file, then replaces the old file with it (atomic). the -
+   temp file is removed if the transfer fails.
+
+the weak checksum is adler32, the same as `zlib.adler32`, rolled in O(1) per -
+byte (see `_roll`), so an insertion or deletion of any length is resynced at -
+the next unchanged block.
+
+small files (< `DELTA_MIN_SIZE`), and files not existing on the receiver, -
+are sent in full (see `transfer.py`).
+
+the air server exposes this module as `delta` (see -
+`file_sync_pro.__main__ : run_air_server`).
+"""
+
+import hashlib
+import os
+import typing as t
+import zlib
+from collections import defaultdict
+from . import compress as compress_
+from . import transfer
+
+
+class T:
+    Batch = t.List[t.Union[int, t.Tuple[bytes, bool]]]
+    #   int: index of a block in the old copy.
+    #   (data, is_compressed): a literal range.
+    Exec = transfer.T.Exec
+    Path = str
+    Signatures = t.List[t.Tuple[int, str]]  # [(adler32, md5 hex), ...]
+    Time = int
+
+
+DELTA_MIN_SIZE = 1024 * 1024
+
+
+def block_size_for(size: int) -> int:
+    """
+    about `sqrt(size)`, in multiples of 4kb (sqlite's default page size).
+    """
+    return max(4096, int(size ** 0.5) // 4096 * 4096)
+
+
+# -----------------------------------------------------------------------------
+# both sides
+
+
+def signatures(file: T.Path, block_size: int) -> T.Signatures:
+    out = []
+    with open(file, 'rb') as f:
+        while block := f.read(block_size):
+            out.append((zlib.adler32(block), hashlib.md5(block).hexdigest()))
+    return out
+
+
+def make_delta(
+    file: T.Path,
+    sigs: T.Signatures,
+    block_size: int,
+    batch_size: int = transfer.CHUNK_SIZE,
+    compress: bool = False,
+) -> t.Iterator[T.Batch]:
+    """
+    yields batches of ops. literal bytes in a batch are about `batch_size` at -
+    most, and the file is read in windows, so memory use stays flat.
+    
+    params:
+        compress: compress literal ranges if worthwhile, probed per range.
+    """
+    enabled = compress and compress_.by_name(file)
+    
+    def literal(data: bytes) -> t.Tuple[bytes, bool]:
+        if enabled and compress_.probe(data):
+            return compress_.compress(data), True
+        return data, False
+    
+    index = defaultdict(list)  # {weak: [(block index, strong), ...]}
+    for i, (weak, strong) in enumerate(sigs):
+        index[weak].append((i, strong))
+
+    batch: T.Batch = []
+    batch_bytes = 0
+    window = max(batch_size, block_size * 4)
+    with open(file, 'rb') as f:
+        buf = f.read(window)
+        eof = len(buf) < window
+        pos = 0  # start of the block window in `buf`.
+        lit = 0  # start of the pending literal range in `buf`.
+        weak = None
+        while True:
+            if len(buf) - pos <= block_size and not eof:
+                # keep one byte after the window for rolling.
+                if pos > lit:
+                    batch.append(literal(buf[lit:pos]))
+                    batch_bytes += pos - lit
+                more = f.read(window)
+                eof = len(more) < window
+                buf = buf[pos:] + more
+                pos = lit = 0
+            n = min(block_size, len(buf) - pos)
+            if n <= 0:
+                break
+            if weak is None:
+                weak = zlib.adler32(buf[pos:pos + n])
+            if weak not in index and pos + n < len(buf):
+                # fast path: roll over the bytes without a weak hit, inlined.
+                pos, weak = _roll_to_hit(buf, pos, n, weak, index)
+            if (candidates := index.get(weak)) and (
+                i := _match(candidates, buf[pos:pos + n])
+            ) is not None:
+                if pos > lit:
+                    batch.append(literal(buf[lit:pos]))
+                    batch_bytes += pos - lit
+                batch.append(i)
+                pos += n
+                lit = pos
+                weak = None
+            else:
+                if pos + n < len(buf):
+                    x_in = buf[pos + n]
+                else:
+                    assert eof  # `buf` is refilled ahead of its end.
+                    x_in = None
+                weak = _roll(weak, buf[pos], x_in, n)
+                pos += 1
+            if batch_bytes + pos - lit >= batch_size or len(batch) >= 10000:
+                if pos > lit:
+                    batch.append(literal(buf[lit:pos]))
+                    batch_bytes += pos - lit
+                    lit = pos
+                yield batch
+                batch = []
+                batch_bytes = 0
+    if pos > lit:
+        batch.append(literal(buf[lit:pos]))
+    if batch:
+        yield batch
+
+
+def _match(
+    candidates: t.List[t.Tuple[int, str]], block: bytes
+) -> t.Optional[int]:
+    strong = hashlib.md5(block).hexdigest()
+    for i, s in candidates:
+        if s == strong:
+            return i
+    return None
+
+
+def _roll_to_hit(
+    buf: bytes, pos: int, n: int, weak: int, index: t.Container[int]
+) -> t.Tuple[int, int]:
+    """
+    roll a full window of `n` bytes on, until its weak checksum is in -
+    `index`, or one byte before the end of `buf`. the last byte is left to -
+    the caller's `_roll`, which is the only one to shrink the window (at the -
+    end of file), or to a refill of `buf`.
+    returns: (pos, weak)
+    """
+    a = weak & 0xFFFF
+    b = weak >> 16
+    end = len(buf) - n - 1
+    while pos < end:
+        x = buf[pos]
+        a = (a - x + buf[pos + n]) % 65521
+        b = (b - n * x + a - 1) % 65521
+        pos += 1
+        if ((b << 16) | a) in index:
+            break
+    return pos, (b << 16) | a
+
+
+def _roll(weak: int, x_out: int, x_in: t.Optional[int], n: int) -> int:
+    """
+    move the adler32 of a window of `n` bytes one byte on: `x_out` leaves -
+    from the front, `x_in` comes in at the back. if `x_in` is None (the end -
+    of file), the window shrinks to `n - 1` bytes.
+    """
+    a = weak & 0xFFFF
+    b = weak >> 16
+    if x_in is None:
+        a = (a - x_out) % 65521
+        b = (b - n * x_out - 1) % 65521
+    else:
+        a = (a - x_out + x_in) % 65521
+        b = (b - n * x_out + a - 1) % 65521
+    return (b << 16) | a
+
+
+def apply_batch(
+    file: T.Path, tmp: T.Path, batch: T.Batch, block_size: int, first: bool
+) -> None:
+    """
+    append the data of `batch` to `tmp`, taking blocks from `file` (the old -
+    copy).
+    """
+    with open(file, 'rb') as f, open(tmp, 'wb' if first else 'ab') as o:
+        for op in batch:
+            if isinstance(op, int):
+                f.seek(op * block_size)
+                o.write(f.read(block_size))
+            else:
+                data, z = op
+                o.write(compress_.decompress(data) if z else data)
+
+
+def commit(tmp: T.Path, file: T.Path, mtime: T.Time) -> None:
+    os.utime(tmp, (mtime, mtime))
+    os.replace(tmp, file)
+
+
+def discard(tmp: T.Path) -> None:
+    transfer.remove_temp(tmp)
+
+
+# -----------------------------------------------------------------------------
+# client side
+
+
+def upload(
+    exec_: T.Exec,
+    file_i: T.Path,
+    file_o: T.Path,
+    mtime: t.Optional[T.Time] = None,
+    compress: bool = False,
+) -> None:
+    """
+    like `transfer.upload`, but only sends what differs from the remote old -
+    copy.
+    
+    params:
+        compress: compress literal ranges if worthwhile, also used when -
+            falling back to `transfer.upload`.
+    """
+    size = os.path.getsize(file_i)
+    if size < DELTA_MIN_SIZE:
+        transfer.upload(exec_, file_i, file_o, mtime, compress=compress)
+        return
+    if mtime is None:
+        mtime = int(os.path.getmtime(file_i))
+    block_size = block_size_for(size)
+    sigs = exec_(
+        '''
+        if not os.path.isfile(file):
+            return None
+        return delta.signatures(file, block_size)
+        ''',
+        file=file_o,
+        block_size=block_size,
+    )
+    if not sigs:
+        transfer.upload(exec_, file_i, file_o, mtime, compress=compress)
+        return
+    # the temp file is skipped by tree scans, see `transfer.temp_path`.
+    tmp = transfer.temp_path(file_o)
+    sent = 0
+    first = True
+    try:
+        for batch in transfer.prefetch(
+            make_delta(file_i, sigs, block_size, compress=compress)
+        ):
+            exec_(
+                'delta.apply_batch(file, tmp, batch, block_size, first)',
+                file=file_o,
+                tmp=tmp,
+                batch=batch,
+                block_size=block_size,
+                first=first,
+            )
+            first = False
+            sent += _literal_bytes(batch)
+        exec_(
+            'delta.commit(tmp, file, mtime)', tmp=tmp, file=file_o, mtime=mtime
+        )
+    except BaseException:
+        try:
+            exec_('delta.discard(tmp)', tmp=tmp)
+        except Exception:
+            pass  # e.g. the link is down, the temp file is left.
+        raise
+    print(':v1', 'delta sent {} of {} bytes: {}'.format(sent, size, file_o))
+
+
+def download(
+    exec_: T.Exec,
+    file_i: T.Path,
+    file_o: T.Path,
+    mtime: t.Optional[T.Time] = None,
+    compress: bool = False,
+) -> None:
+    """
+    like `transfer.download`, but only receives what differs from the local -
+    old copy.
+    
+    params:
+        compress: compress literal ranges on server side if worthwhile, also -
+            used when falling back to `transfer.download`.
+    """
+    if not os.path.isfile(file_o) or (
+        (size := os.path.getsize(file_o)) < DELTA_MIN_SIZE
+    ):
+        transfer.download(exec_, file_i, file_o, mtime, compress=compress)
+        return
+    block_size = block_size_for(size)
+    batches = exec_(
+        'return delta.make_delta(file, sigs, block_size, compress=compress)',
+        file=file_i,
+        sigs=signatures(file_o, block_size),
+        block_size=block_size,
+        compress=compress,
+    )
+    tmp = transfer.temp_path(file_o)
+    received = 0
+    first = True
+    try:
+        for batch in transfer.prefetch(batches):
+            apply_batch(file_o, tmp, batch, block_size, first)
+            first = False
+            received += _literal_bytes(batch)
+        if first:  # the remote file is empty.
+            open(tmp, 'wb').close()
+        if mtime is None:
+            mtime = exec_(
+                'return int(os.path.getmtime(file))', file=file_i
+            )
+        commit(tmp, file_o, mtime)
+    except BaseException:
+        discard(tmp)
+        raise
+    print(':v1', 'delta received {} bytes: {}'.format(received, file_o))
+
+
+def _literal_bytes(batch: T.Batch) -> int:
+    """
+    returns: bytes of literal ranges on the wire.
+    """
+    return sum(len(op[0]) for op in batch if not isinstance(op, int))
+
+
+# -----------------------------------------------------------------------------
+# regression check
+
+
+def _check_large_insertion(
+    size: int = 4 * 1024 * 1024, insertion: int = 1536 * 1024
+) -> None:
+    """
+    an unmatched run longer than the read window of `make_delta` must be -
+    resynced at the next unchanged block, not turn the rest of the file -
+    into literals.
+    """
+    import tempfile
+    old = os.urandom(size)
+    with tempfile.TemporaryDirectory() as d:
+        file_old, file_new, tmp = d + '/old', d + '/new', d + '/tmp'
+        for new in (
+            os.urandom(insertion) + old,
+            old[:size // 2] + os.urandom(insertion) + old[size // 2:],
+        ):
+            with open(file_old, 'wb') as f:
+                f.write(old)
+            with open(file_new, 'wb') as f:
+                f.write(new)
+            block_size = block_size_for(size)
+            ops = [
+                x
+                for batch in make_delta(
+                    file_new, signatures(file_old, block_size), block_size
+                )
+                for x in batch
+            ]
+            assert _literal_bytes(ops) == insertion, _literal_bytes(ops)
+            assert sum(isinstance(x, int) for x in ops) == size // block_size
+            apply_batch(file_old, tmp, ops, block_size, True)
+            with open(tmp, 'rb') as f:
+                assert f.read() == new
+    print(':v4', 'delta resyncs after a large insertion')
+
+
+if __name__ == '__main__':
+    # pox -m file_sync_pro.filesys2.delta
+    _check_large_insertion()
@@ -0,0 +1,152 @@
+"""
+fold file system events (from `watchdog`) into a node map.
+"""
+
+import os
+import threading
+import typing as t
+from . import local
+from .ignores import make_matcher
+from .ignores import with_defaults
+from .transfer import TEMP_SUFFIX
+
+
+class T:
+    Path = str
+    RelPath = str
+    Tree = t.Dict[RelPath, int]
+
+
+class EventFolder:
+    """
+    a watchdog event handler that folds events into a node map.
+    """
+    
+    def __init__(
+        self,
+        root: T.Path,
+        files: T.Tree,
+        dirs: T.Tree,
+        ignores: t.Iterable[str] = (),
+        skip_file: T.Path = '',
+        stats: t.Dict[T.RelPath, list] = None,
+    ) -> None:
+        """
+        params:
+            files, dirs: node maps to be updated in place.
+            stats: optional `{relpath: stat}` map to be updated in place, see -
+                `local.make_stat`.
+            skip_file: a file whose events are ignored, usually the snapshot -
+                file itself if it is inside root.
+        """
+        self.dirs = dirs
+        self.dirty = False
+        self.files = files
+        self.lock = threading.Lock()
+        self.root = root
+        self.stats = stats
+        self._match = make_matcher(with_defaults(ignores))
+        self._skip_file = skip_file
+    
+    def dispatch(self, event) -> None:
+        if event.event_type not in ('created', 'deleted', 'modified', 'moved'):
+            return
+        with self.lock:
+            if event.event_type == 'moved':
+                self._remove(event.src_path, event.is_directory)
+                self._add(event.dest_path, event.is_directory)
+            elif event.event_type == 'deleted':
+                self._remove(event.src_path, event.is_directory)
+            elif event.event_type == 'modified' and event.is_directory:
+                # sent along with every create/delete in the dir, whose own
+                # events carry the file changes. only its mtime is refreshed.
+                self._touch_dir(event.src_path)
+            else:
+                self._add(event.src_path, event.is_directory)
+    
+    def _add(self, path: str, is_dir: bool) -> None:
+        if (key := self._get_key(path, is_dir)) is None:
+            return
+        if is_dir:
+            try:
+                self.dirs[key] = int(os.stat(path).st_mtime)
+                listed, dirs = local.scan_tree(path)
+            except FileNotFoundError:
+                return
+            for dirkey, names in listed.items():
+                prefix = key + '/' if dirkey == '.' else (
+                    '{}/{}/'.format(key, dirkey)
+                )
+                for name, mtime, *stat in names:
+                    if not (self._match and self._match(prefix + name)):
+                        self.files[prefix + name] = mtime
+                        if self.stats is not None:
+                            self.stats[prefix + name] = local.make_stat(*stat)
+            for dirkey, mtime in dirs.items():
+                if not (self._match and self._match(f'{key}/{dirkey}/')):
+                    self.dirs[f'{key}/{dirkey}'] = mtime
+        else:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self.files.pop(key, None)
+                if self.stats is not None:
+                    self.stats.pop(key, None)
+            else:
+                self.files[key] = int(st.st_mtime)
+                if self.stats is not None:
+                    self.stats[key] = local.make_stat(
+                        st.st_size, st.st_dev, st.st_ino
+                    )
+        self._touch_parent(key)
+        self.dirty = True
+    
+    def _remove(self, path: str, is_dir: bool) -> None:
+        if (key := self._get_key(path, is_dir)) is None:
+            return
+        if is_dir:
+            prefix = key + '/'
+            for k in tuple(k for k in self.files if k.startswith(prefix)):
+                self.files.pop(k)
+                if self.stats is not None:
+                    self.stats.pop(k, None)
+            for k in tuple(k for k in self.dirs if k.startswith(prefix)):
+                self.dirs.pop(k)
+            self.dirs.pop(key, None)
+        else:
+            self.files.pop(key, None)
+            if self.stats is not None:
+                self.stats.pop(key, None)
+        self._touch_parent(key)
+        self.dirty = True
+    
+    def _get_key(self, path: str, is_dir: bool) -> t.Optional[T.RelPath]:
+        """
+        returns: relpath, or None if path should be ignored.
+        """
+        path = path.replace('\\', '/')
+        if path == self._skip_file or not path.startswith(self.root + '/'):
+            return None
+        if not is_dir and path.endswith(TEMP_SUFFIX):
+            return None
+        key = path[len(self.root) + 1:]
+        if self._match and self._match(key + '/' if is_dir else key):
+            return None
+        return key
+    
+    def _touch_dir(self, path: str) -> None:
+        if (key := self._get_key(path, True)) is None:
+            return
+        try:
+            self.dirs[key] = int(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            return
+        self.dirty = True
+    
+    def _touch_parent(self, key: T.RelPath) -> None:
+        if '/' in key:
+            d = key.rsplit('/', 1)[0]
+            try:
+                self.dirs[d] = int(os.stat(f'{self.root}/{d}').st_mtime)
+            except FileNotFoundError:
+                pass
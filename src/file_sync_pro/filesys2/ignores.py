@@ -0,0 +1,109 @@
+"""
+compile the `ignores` list of a snapshot file into one regex, which is -
+consulted by walkers before descending into a directory.
+
+pattern rules:
+    -   a literal pattern is a relpath prefix (the same as before), e.g. 'A/', -
+        'B/C/'.
+    -   a pattern containing `*`, `?` or `[` is a glob:
+            `*`     matches anything except '/'.
+            `**/`   matches zero or more directories.
+            `?`     matches one char except '/'.
+            `[...]` matches one char in the set.
+        a glob matches the whole file relpath, or a directory prefix if it -
+        ends with '/'. for example:
+            '**/node_modules/'  ignores every "node_modules" dir.
+            '**/*.tmp'          ignores every ".tmp" file.
+    -   directories are tested as `<relpath>/`.
+
+`DEFAULT_IGNORES` are ignored by the tree walkers on top of the snapshot's -
+own patterns, see `with_defaults`.
+"""
+
+import re
+import typing as t
+
+__all__ = [
+    'DEFAULT_IGNORES', 'compile_ignores', 'make_matcher', 'with_defaults'
+]
+
+# the same as `lk_utils.fs.default_filter`, which the walkers used before -
+# they were rewritten with `os.scandir`. note that temp files of unfinished -
+# transfers ('*.fsp-part~') are covered by '**/*~'.
+DEFAULT_IGNORES = (
+    '**/.git/',
+    '**/.idea/',
+    '**/.vscode/',
+    '**/__pycache__/',
+    '**/.DS_Store',
+    '**/.gitkeep',
+    '**/~*',
+    '**/*~',
+)
+
+
+def compile_ignores(patterns: t.Iterable[str]) -> str:
+    """
+    returns: regex source, or an empty string if there is no pattern.
+        the source is a plain string so that it can be sent to the air server.
+    """
+    out = []
+    for p in patterns:
+        if not p:
+            continue
+        if '*' in p or '?' in p or '[' in p:
+            out.append(_glob_to_regex(p))
+        else:
+            out.append(re.escape(p))
+    return '|'.join('(?:{})'.format(x) for x in out)
+
+
+def make_matcher(
+    patterns: t.Iterable[str]
+) -> t.Optional[t.Callable[[str], t.Any]]:
+    """
+    returns: a `match(relpath)` function, or None if there is no pattern.
+        usage: `if match and match(key): <ignore it>`.
+    """
+    if source := compile_ignores(patterns):
+        return re.compile(source).match
+    return None
+
+
+def with_defaults(patterns: t.Iterable[str]) -> t.Tuple[str, ...]:
+    """
+    returns: `DEFAULT_IGNORES` followed by `patterns`.
+    """
+    return (*DEFAULT_IGNORES, *patterns)
+
+
+def _glob_to_regex(pattern: str) -> str:
+    i = 0
+    n = len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body[0] == '!':
+                    body = '^' + body[1:]
+                out.append('[{}]'.format(body.replace('\\', '\\\\')))
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    if not pattern.endswith('/'):
+        out.append(r'(?:/|\Z)')
+    return ''.join(out)
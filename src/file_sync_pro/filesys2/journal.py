@@ -0,0 +1,251 @@
+"""
+a change journal that runs on the air server.
+
+the client asks "what changed since version X" for a root, and gets only the -
+added, modified and removed files, instead of pulling the full listing.
+the journal only tracks mtimes, stats (size, inode) of the changed files are -
+taken on query, and sent along with the current dir-mtime table.
+
+changes are collected by `watchdog` (inotify on termux/linux). if it is not -
+available or fails to start (e.g. too many watches), the root is rescanned -
+on each query with the dir-mtime table, which is still much cheaper than a -
+full listing. a full rescan also runs on query once the last one is older -
+than `rescan_interval`, as a safety net for lost events.
+
+usage (on server side, see `file_sync_pro.__main__ : run_air_server`):
+    air.run_server({..., 'journal': journal.server})
+"""
+
+import os
+import threading
+import typing as t
+from time import time
+from uuid import uuid1
+from . import local
+from .events import EventFolder
+from .ignores import compile_ignores
+
+
+class T:
+    Path = str
+    RelPath = str
+    Time = int
+    Tree = t.Dict[RelPath, Time]
+    Token = str  # `<session>:<seq>`, or empty string for "never synced".
+    Changes = t.TypedDict('Changes', {
+        'token'   : Token,
+        'full'    : bool,
+        #   if true, `added` contains all files, and the client should replace
+        #   its node map instead of applying changes to it.
+        'added'   : Tree,
+        'modified': Tree,
+        'removed' : t.List[RelPath],
+        'stats'   : t.Dict[RelPath, t.List[int]],
+        #   stats of `added` and `modified` files, see `local.make_stat`. a
+        #   file removed right after the change may be absent.
+        'dirs'    : Tree,
+        #   `{dir_relpath: mtime, ...}` of all watched dirs.
+    })
+    LogItem = t.Tuple[int, RelPath, t.Optional[Time], t.Optional[Time]]
+    #   (seq, key, old_mtime, new_mtime), mtime is None if file not exists.
+
+
+class JournaledNodes(dict):
+    """
+    a node map that records every change into a log.
+    """
+
+    def __init__(self, data: T.Tree, max_log: int) -> None:
+        super().__init__(data)
+        self.floor = 0  # the oldest seq which can be answered.
+        self.log: t.List[T.LogItem] = []
+        self.seq = 0
+        self._max_log = max_log
+
+    def __setitem__(self, key: T.RelPath, value: T.Time) -> None:
+        old = self.get(key)
+        if old != value:
+            self._record(key, old, value)
+        super().__setitem__(key, value)
+
+    def pop(self, key: T.RelPath, *default):
+        if key in self:
+            self._record(key, self[key], None)
+        return super().pop(key, *default)
+
+    def changes_since(self, seq: int) -> t.Tuple[T.Tree, T.Tree, list]:
+        first_old = {}
+        last_new = {}
+        for s, k, old, new in reversed(self.log):
+            if s <= seq:
+                break
+            first_old[k] = old
+            last_new.setdefault(k, new)
+        added = {}
+        modified = {}
+        removed = []
+        for k, old in first_old.items():
+            new = last_new[k]
+            if old is None:
+                if new is not None:
+                    added[k] = new
+            elif new is None:
+                removed.append(k)
+            elif new != old:
+                modified[k] = new
+        return added, modified, removed
+
+    def _record(self, key: T.RelPath, old, new) -> None:
+        self.seq += 1
+        self.log.append((self.seq, key, old, new))
+        if len(self.log) > self._max_log:
+            drop = len(self.log) // 2
+            self.floor = self.log[drop - 1][0]
+            del self.log[:drop]
+
+
+class _WatchedRoot:
+
+    def __init__(
+        self,
+        root: T.Path,
+        ignores: t.Sequence[str],
+        max_log: int,
+        rescan_interval: float,
+    ) -> None:
+        self.ignores = ignores
+        self.root = root
+        self._observer = None
+        self._rescan_interval = rescan_interval
+
+        listed, dirs = local.scan_tree(root, ignores)
+        self.nodes = JournaledNodes(_flatten(listed), max_log)
+        self.folder = EventFolder(root, self.nodes, dirs, ignores)
+        self._last_rescan = time()
+
+        try:
+            from watchdog.observers import Observer
+            observer = Observer()
+            observer.schedule(self.folder, root, recursive=True)
+            observer.start()
+        except Exception as e:
+            print(':v6', 'cannot watch "{}", fallback to rescan: {}'.format(
+                root, e
+            ))
+        else:
+            self._observer = observer
+
+    def refresh(self) -> None:
+        outdated = time() - self._last_rescan > self._rescan_interval
+        if self._observer is None:
+            self._rescan(full=outdated)
+        elif outdated:
+            self._rescan(full=True)
+
+    def stop(self) -> None:
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+
+    def _rescan(self, full: bool) -> None:
+        with self.folder.lock:
+            old_files = dict(self.nodes)
+            old_dirs = self.folder.dirs
+        listed, dirs = local.scan_tree(
+            self.root, self.ignores, None if full else old_dirs
+        )
+        new_files = _flatten(listed)
+        for k, v in old_files.items():
+            d = k.rsplit('/', 1)[0] if '/' in k else '.'
+            if d not in listed and d in dirs:
+                new_files[k] = v
+        with self.folder.lock:
+            for k in old_files.keys() - new_files.keys():
+                self.nodes.pop(k, None)
+            for k, v in new_files.items():
+                self.nodes[k] = v
+            self.folder.dirs.clear()
+            self.folder.dirs.update(dirs)
+        if full:
+            self._last_rescan = time()
+
+
+class ChangeJournal:
+    def __init__(
+        self, max_log: int = 1_000_000, rescan_interval: float = 600
+    ) -> None:
+        """
+        params:
+            max_log: if the log exceeds it, the older half is dropped. clients -
+                with a token older than that get a full listing.
+            rescan_interval: seconds between two full rescans.
+        """
+        self.session = uuid1().hex[:8]
+        self._lock = threading.Lock()
+        self._max_log = max_log
+        self._rescan_interval = rescan_interval
+        self._roots: t.Dict[T.Path, _WatchedRoot] = {}
+
+    def changes_since(
+        self, root: T.Path, token: T.Token = '', ignores: t.Sequence[str] = ()
+    ) -> T.Changes:
+        ignores = tuple(ignores)
+        with self._lock:
+            watched = self._roots.get(root)
+            if watched and compile_ignores(watched.ignores) != (
+                compile_ignores(ignores)
+            ):
+                watched.stop()
+                watched = None
+            if watched is None:
+                watched = self._roots[root] = _WatchedRoot(
+                    root, ignores, self._max_log, self._rescan_interval
+                )
+                token = ''
+        watched.refresh()
+
+        nodes = watched.nodes
+        session, seq = token.split(':') if token else ('', '0')
+        with watched.folder.lock:
+            new_token = '{}:{}'.format(self.session, nodes.seq)
+            dirs = dict(watched.folder.dirs)
+            if session != self.session or int(seq) < nodes.floor:
+                full = True
+                added, modified, removed = dict(nodes), {}, []
+            else:
+                full = False
+                added, modified, removed = nodes.changes_since(int(seq))
+        return {
+            'token'   : new_token,
+            'full'    : full,
+            'added'   : added,
+            'modified': modified,
+            'removed' : removed,
+            'stats'   : _stat_files(root, (*added, *modified)),
+            'dirs'    : dirs,
+        }
+
+
+def _stat_files(
+    root: T.Path, keys: t.Iterable[T.RelPath]
+) -> t.Dict[T.RelPath, t.List[int]]:
+    out = {}
+    for k in keys:
+        try:
+            st = os.stat('{}/{}'.format(root, k))
+        except OSError:
+            continue
+        out[k] = local.make_stat(st.st_size, st.st_dev, st.st_ino)
+    return out
+
+
+def _flatten(listed: t.Dict[T.RelPath, t.List[tuple]]) -> T.Tree:
+    out = {}
+    for dirkey, names in listed.items():
+        prefix = '' if dirkey == '.' else dirkey + '/'
+        for name, mtime, *_ in names:
+            out[prefix + name] = mtime
+    return out
+
+
+server = ChangeJournal()
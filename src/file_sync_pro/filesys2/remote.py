@@ -3,6 +3,10 @@ import os
 import typing as t
 from collections import namedtuple
 from functools import partial
+from . import delta as delta_
+from . import transfer
+from .ignores import compile_ignores
+from .ignores import with_defaults
 
 
 def is_local_path(path):
@@ -61,6 +65,68 @@ class FileSystem:
     def url(self):
         return 'air://{}:{}'.format(self.client.host, self.client.port)
     
+    def clone(self) -> 'FileSystem':
+        """
+        open another connection to the same server, e.g. for concurrent -
+        transfers (one connection per thread).
+        """
+        client = air.Client(host=self.client.host, port=self.client.port)
+        client.open()
+        return FileSystem(client)
+    
+    def close(self) -> None:
+        self.client.close()
+    
+    def download_file(
+        self,
+        file_i: str,
+        file_o: str,
+        mtime: t.Optional[int] = None,
+        delta: bool = False,
+        compress: bool = False,
+    ) -> None:
+        """
+        stream a remote file to local in chunks, see `transfer.download`.
+        
+        params:
+            delta: if `file_o` exists, only receive the changed parts, see -
+                `delta.py`.
+            compress: compress on the wire if worthwhile, see `compress.py`.
+        """
+        if delta:
+            delta_.download(
+                self.client.exec, file_i, file_o, mtime, compress=compress
+            )
+        else:
+            transfer.download(
+                self.client.exec, file_i, file_o, mtime, compress=compress
+            )
+    
+    def upload_file(
+        self,
+        file_i: str,
+        file_o: str,
+        mtime: t.Optional[int] = None,
+        delta: bool = False,
+        compress: bool = False,
+    ) -> None:
+        """
+        stream a local file to remote in chunks, see `transfer.upload`.
+        
+        params:
+            delta: if `file_o` exists, only send the changed parts, see -
+                `delta.py`.
+            compress: compress on the wire if worthwhile, see `compress.py`.
+        """
+        if delta:
+            delta_.upload(
+                self.client.exec, file_i, file_o, mtime, compress=compress
+            )
+        else:
+            transfer.upload(
+                self.client.exec, file_i, file_o, mtime, compress=compress
+            )
+    
     def find_files(self, root):
         Path = namedtuple('Path', 'path relpath mtime')
         for tuple_ in self.client.exec(
@@ -100,6 +166,114 @@ class FileSystem:
         ):
             yield Path(*tuple_)
     
+    def fetch_changes(
+        self, root: str, token: str = '', exclusion: t.Tuple[str, ...] = ()
+    ) -> t.Optional[dict]:
+        """
+        ask the change journal on server side for changes since `token`.
+        see `journal.ChangeJournal.changes_since`.
+        
+        returns: None if the server has no journal (an older -
+            `run_air_server`).
+        """
+        return self.client.exec(
+            '''
+            try:
+                server = journal
+            except NameError:
+                return None
+            return server.changes_since(root, token, ignores)
+            ''',
+            root=root,
+            token=token,
+            ignores=exclusion,
+        )
+    
+    def scan_tree(
+        self,
+        root: str,
+        exclusion: t.Tuple[str, ...] = (),
+        dirs_history: t.Dict[str, int] = None,
+    ) -> t.Tuple[
+        t.Dict[str, t.List[t.Tuple[str, int, int, int, int]]],
+        t.Dict[str, int],
+    ]:
+        """
+        walk the whole tree on server side, and return the result in one -
+        response, instead of yielding items one by one.
+        
+        params:
+            exclusion: ignore patterns, e.g. ('A/', '**/node_modules/'). see
+                `ignores.py`. they are compiled to one regex (along with -
+                `ignores.DEFAULT_IGNORES`) and matched on server side, -
+                ignored dirs are not descended.
+            dirs_history: `{dir_relpath: mtime, ...}` from the last scan. files
+                of a directory whose mtime is unchanged are not stat'ed and not
+                sent back, the caller should reuse them from its history.
+        returns: (files, dirs)
+            files: `{dir_relpath: [(filename, mtime, size, dev, inode), ...]}`
+                the root dir is keyed as '.'. only listed dirs are included.
+                grouping by dir avoids repeating the dir part of every relpath.
+            dirs: `{dir_relpath: mtime, ...}` of all walked dirs.
+        
+        symlinked dirs are not descended, and entries which cannot be read -
+        (dangling symlinks, unreadable dirs) are skipped, like `os.walk`. -
+        temp files of unfinished transfers are skipped too, see `transfer.py`.
+        """
+        files, dirs = self.client.exec(
+            '''
+            def scan():
+                import re
+                match = re.compile(ignores).match if ignores else None
+                hist = dirs_history or {}
+                files = {}
+                dirs = {}
+                todo = [(root, '.')]
+                while todo:
+                    dirpath, dirkey = todo.pop()
+                    prefix = '' if dirkey == '.' else dirkey + '/'
+                    reuse = dirkey != '.' and hist.get(dirkey) == dirs[dirkey]
+                    names = None if reuse else []
+                    try:
+                        entries = list(os.scandir(dirpath))
+                    except OSError:
+                        # unreadable, left unlisted (see `local.scan_tree`).
+                        continue
+                    for e in entries:
+                        key = prefix + e.name
+                        try:
+                            if e.is_dir(follow_symlinks=False):
+                                if match and match(key + '/'):
+                                    continue
+                                dirs[key] = int(e.stat().st_mtime)
+                                todo.append((e.path, key))
+                            elif names is not None and e.is_file():
+                                if match and match(key):
+                                    continue
+                                if e.name.endswith(temp_suffix):
+                                    continue
+                                st = e.stat()
+                                names.append((
+                                    e.name,
+                                    int(st.st_mtime),
+                                    st.st_size,
+                                    st.st_dev,
+                                    st.st_ino,
+                                ))
+                        except OSError:
+                            continue
+                    if names is not None:
+                        files[dirkey] = names
+                return files, dirs
+            return scan()
+            ''',
+            root=root,
+            ignores=compile_ignores(with_defaults(exclusion)),
+            dirs_history=dirs_history,
+            temp_suffix=transfer.TEMP_SUFFIX,
+        )
+        return files, dirs
+    
     def _fast_call(self, func_name, *args0, **args1):
         return self.client.exec(
             'fs.{}(*args0, **args1)'.format(func_name),
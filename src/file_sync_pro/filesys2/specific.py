@@ -1,10 +1,13 @@
 import airmise as air
-from collections import defaultdict
 from typing import Dict
 from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Tuple
 from . import local
 from . import remote
+from .ignores import make_matcher
+from .ignores import with_defaults
 
 
 class T:
@@ -13,6 +16,7 @@ class T:
     Time = int
     TimeChanges = Dict[RelPath, Time]
     Tree = Dict[RelPath, Time]
+    Stats = Dict[RelPath, List[int]]  # see `local.make_stat`
 
 
 class FileSystem:
@@ -57,57 +61,150 @@ class FileSystem:
         for d in self._fs1.findall_dirs(root):
             yield d.relpath, d.mtime
 
-    def findall_files(
-        self, root: T.DirPath, history: Tuple[T.Tree, T.Time] = None
-    ) -> Iterator[Tuple[T.RelPath, T.Time]]:
-        file_2_mtime = {}
-        dir_2_mtime = {}
-        dir_2_files = defaultdict(list)
-        if history:
-            file_2_mtime = history[0]
-            dir_2_mtime = history[1]
-            for k, v in file_2_mtime.items():
-                d = k.rsplit('/', 1)[0] if '/' in k else '.'
-                dir_2_files[d].append((k, v))
+    def findall_nodes(self, root: T.DirPath, exclusion=()) -> T.TimeChanges:
+        """
+        exclusion: e.g. ('A/', 'B/C/', '**/node_modules/')
+        """
+        return self.findall_tree(root, exclusion=exclusion)[0]
+
+    def fetch_tree_changes(
+        self,
+        root: T.DirPath,
+        files: T.Tree,
+        token: str = '',
+        exclusion: Tuple[T.RelPath, ...] = (),
+        stats: T.Stats = None,
+    ) -> Optional[Tuple[T.Tree, T.Tree, str, float]]:
+        """
+        apply changes since `token` from the change journal of air server to -
+        `files`. only available for remote root.
+        
+        params:
+            files: the node map at `token`. it is updated in place.
+            stats: the stats map at `token`. it is updated in place, stats of -
+                changed files are refreshed by the server in the same call.
+            token: empty string means "never synced", a full listing will be -
+                returned.
+        returns: (files, dirs, new_token, reuse_ratio), or None if the server -
+            has no change journal, then the caller should fall back to -
+            `findall_tree`.
+            dirs: `{dir_relpath: mtime, ...}` as the journal sees now. empty if -
+                the server doesn't send it, which makes the next -
+                `findall_tree` rescan every dir.
+        """
+        assert self.is_remote
+        changes = self._fs1.fetch_changes(root, token, exclusion)
+        if changes is None:
+            print(':v6', 'no change journal on server, fallback to scan')
+            return None
+        if changes['full']:
+            old_files = files
+            files = changes['added']
+            reuse_count = sum(
+                1 for k, v in files.items() if old_files.get(k) == v
+            )
+            if stats is not None:
+                for k in tuple(stats):
+                    if old_files.get(k) != files.get(k):
+                        stats.pop(k)
+        else:
+            if stats is not None:
+                for k in (
+                    *changes['added'], *changes['modified'], *changes['removed']
+                ):
+                    stats.pop(k, None)
+            for k in changes['removed']:
+                files.pop(k, None)
+            files.update(changes['added'])
+            files.update(changes['modified'])
+            reuse_count = len(files) - len(changes['added']) - len(
+                changes['modified']
+            )
+            for k in (*changes['added'], *changes['modified']):
+                print(':i3p', k)
+            print(':v2p', '{} added, {} modified, {} removed'.format(
+                len(changes['added']),
+                len(changes['modified']),
+                len(changes['removed']),
+            ))
+        if stats is not None:
+            stats.update(changes.get('stats', {}))
+        ratio = reuse_count / len(files) if files else 0.0
+        return files, changes.get('dirs', {}), changes['token'], ratio
 
+    def findall_tree(
+        self,
+        root: T.DirPath,
+        history: Tuple[T.Tree, T.Tree, T.Stats] = None,
+        exclusion: Tuple[T.RelPath, ...] = (),
+        reuse_dirs: bool = False,
+    ) -> Tuple[T.Tree, T.Tree, T.Stats, float]:
+        """
+        walk the tree in bulk: a local root is walked by a thread pool (see -
+        `local.scan_tree`), a remote root by the air server in one call (see -
+        `remote.FileSystem.scan_tree`).
+        
+        params:
+            history: `(files, dirs, stats)` from the last scan. files are -
+                compared with it for the reuse ratio.
+            exclusion: ignore patterns, e.g. ('A/', '**/node_modules/'). see -
+                `ignores.py`. ignored dirs are not descended.
+            reuse_dirs: if true, a directory whose mtime is unchanged in -
+                `history` reuses its files (and their stats) from it, -
+                instead of stat'ing them again. reused files are filtered by -
+                the current `exclusion`.
+                be noted a file modified in place doesn't change its parent's -
+                mtime, so this kind of change is missed.
+        returns: (files, dirs, stats, reuse_ratio)
+            files: `{relpath: mtime, ...}`
+            dirs: `{dir_relpath: mtime, ...}` of every walked directory, -
+                which is the `dirs` part of the next `history`.
+            stats: `{relpath: [size] | [size, dev, inode]}`. reused files -
+                without a stat in history have none.
+            reuse_ratio: 0.0 ~ 1.0, files reused from history or unchanged.
+        """
+        file_2_mtime, dir_2_mtime, file_2_stat = history or ({}, {}, {})
+        if not reuse_dirs:
+            dir_2_mtime = None
+        if self.is_remote:
+            # the tree is walked by the air server in one call.
+            listed, dirs = self._fs1.scan_tree(root, exclusion, dir_2_mtime)
+        else:
+            listed, dirs = local.scan_tree(root, exclusion, dir_2_mtime)
+
+        files = {}
+        stats = {}
         total_count = 0
         reuse_count = 0
-
-        def submit_files(dirpath):
-            nonlocal total_count, reuse_count
-            for f in self._fs1.find_files(dirpath):
-                key = self._fs0.relpath(f.path, root)
-                yield key, f.mtime
+        for dirkey, names in listed.items():
+            prefix = '' if dirkey == '.' else dirkey + '/'
+            for name, mtime, *stat in names:
+                key = prefix + name
+                files[key] = mtime
+                stats[key] = local.make_stat(*stat)
                 total_count += 1
-                if f.mtime == file_2_mtime.get(key):
+                if mtime == file_2_mtime.get(key):
                     reuse_count += 1
-                else:
+                elif history:
                     print(':i3p', key)
+        match = make_matcher(with_defaults(exclusion))
+        for k, v in file_2_mtime.items():
+            d = k.rsplit('/', 1)[0] if '/' in k else '.'
+            if d not in listed and d in dirs:
+                if match and match(k):
+                    continue
+                files[k] = v
+                if k in file_2_stat:
+                    stats[k] = file_2_stat[k]
+                total_count += 1
+                reuse_count += 1
 
-        yield from submit_files(root)
-        for d in self._fs1.findall_dirs(root):
-            key = d.relpath
-            if d.mtime == dir_2_mtime.get(key):
-                yield from (xlist := dir_2_files[key])
-                total_count += len(xlist)
-                reuse_count += len(xlist)
-            else:
-                yield from submit_files(d.path)
-
+        ratio = reuse_count / total_count if total_count else 0.0
         if history:
             print(
                 ':v2p',
                 'reuse {} of {} files ({:.2%})'.format(
-                    reuse_count, total_count, reuse_count / total_count
+                    reuse_count, total_count, ratio
                 ),
             )
-
-    def findall_nodes(self, root: T.DirPath, exclusion=()) -> T.TimeChanges:
-        """
-        exclusion: e.g. ('A/', 'B/C/')
-        """
-        return dict(
-            (f.relpath, f.mtime)
-            for f in self._fs1.findall_files(root)
-            if (not f.relpath.startswith(exclusion) if exclusion else True)
-        )
+        return files, dirs, stats, ratio
@@ -0,0 +1,242 @@
+"""
+chunked file transfer over an air connection.
+
+a file is sent as a stream of chunks instead of one `bytes` object, so memory -
+use stays flat regardless of file size, and writing starts as soon as the -
+first chunk arrives. the reading side runs in a background thread with a -
+bounded queue (see `prefetch`), so reading the next chunk overlaps with -
+sending/writing the current one.
+
+chunks can be compressed on the wire, see `compress.py`.
+
+the receiver writes into a temp file next to the target (`temp_path`), and -
+replaces the target with it only when all chunks are written and the mtime -
+is set. a dropped link leaves the old file untouched. leftover temp files -
+are skipped by the tree scans (see `local.scan_tree`), and are overwritten -
+by the next transfer of the same file.
+
+`exec_` below is the `exec` function of an air client, e.g. -
+`air.Client.exec` or `airmise.exec`.
+"""
+
+import os
+import queue
+import threading
+import typing as t
+from . import compress as compress_
+
+
+class T:
+    Chunks = t.Iterable[bytes]
+    Exec = t.Callable[..., t.Any]
+    Path = str
+    Time = int
+
+
+CHUNK_SIZE = 1024 * 1024
+PREFETCH = 4  # max number of chunks buffered in memory, on each side.
+TEMP_SUFFIX = '.fsp-part~'
+
+_END = object()
+
+
+def download(
+    exec_: T.Exec,
+    file_i: T.Path,
+    file_o: T.Path,
+    mtime: t.Optional[T.Time] = None,
+    chunk_size: int = CHUNK_SIZE,
+    compress: bool = False,
+) -> None:
+    """
+    params:
+        file_i: remote path.
+        file_o: local path.
+        mtime: if not given, use the mtime of `file_i`.
+        compress: compress chunks on server side if worthwhile.
+    """
+    # the probe of `compress_.probe` is inlined, the older air server -
+    # (`filesys.AirFileSystem`) doesn't have this package.
+    chunks = exec_(
+        '''
+        def read():
+            import zlib
+            z = None
+            with open(file, 'rb') as f:
+                while True:
+                    chunk = f.read(size)
+                    if not chunk:
+                        break
+                    if z is None:
+                        sample = chunk[:probe_size]
+                        z = enabled and len(
+                            zlib.compress(sample, level)
+                        ) < len(sample) * ratio
+                    if z:
+                        yield zlib.compress(chunk, level), True
+                    else:
+                        yield chunk, False
+        return read()
+        ''',
+        file=file_i,
+        size=chunk_size,
+        enabled=compress and compress_.by_name(file_i),
+        level=compress_.LEVEL,
+        probe_size=compress_.PROBE_SIZE,
+        ratio=compress_.PROBE_RATIO,
+    )
+    tmp = temp_path(file_o)
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk, z in prefetch(chunks):
+                f.write(compress_.decompress(chunk) if z else chunk)
+        if mtime is None:
+            mtime = exec_(
+                '''
+                import os
+                return int(os.path.getmtime(file))
+                ''',
+                file=file_i,
+            )
+        os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, file_o)
+    except BaseException:
+        remove_temp(tmp)
+        raise
+
+
+def upload(
+    exec_: T.Exec,
+    file_i: T.Path,
+    file_o: T.Path,
+    mtime: t.Optional[T.Time] = None,
+    chunk_size: int = CHUNK_SIZE,
+    compress: bool = False,
+) -> None:
+    """
+    params:
+        file_i: local path.
+        file_o: remote path.
+        mtime: if not given, use the mtime of `file_i`.
+        compress: compress chunks if worthwhile.
+
+    each chunk is appended to a remote temp file in one round trip. the last -
+    round trip also sets the mtime and replaces `file_o` with it, so a small -
+    file costs one round trip in total.
+    """
+    if mtime is None:
+        mtime = int(os.path.getmtime(file_i))
+    chunks = prefetch(_compressed(
+        read_chunks(file_i, chunk_size),
+        compress and compress_.by_name(file_i),
+    ))
+    tmp = temp_path(file_o)
+    try:
+        chunk, z = next(chunks, (b'', False))
+        first = True
+        while True:
+            nxt = next(chunks, None)
+            exec_(
+                '''
+                import os
+                import zlib
+                with open(tmp, 'wb' if first else 'ab') as f:
+                    f.write(zlib.decompress(data) if z else data)
+                if last:
+                    os.utime(tmp, (mtime, mtime))
+                    os.replace(tmp, file)
+                ''',
+                file=file_o,
+                tmp=tmp,
+                data=chunk,
+                z=z,
+                first=first,
+                last=nxt is None,
+                mtime=mtime,
+            )
+            if nxt is None:
+                break
+            first = False
+            chunk, z = nxt
+    except BaseException:
+        try:
+            exec_(
+                '''
+                import os
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                ''',
+                tmp=tmp,
+            )
+        except Exception:
+            pass  # e.g. the link is down, the temp file is left.
+        raise
+
+
+def temp_path(file: T.Path) -> T.Path:
+    return file + TEMP_SUFFIX
+
+
+def remove_temp(tmp: T.Path) -> None:
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+
+def read_chunks(file: T.Path, chunk_size: int = CHUNK_SIZE) -> T.Chunks:
+    with open(file, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def _compressed(
+    chunks: T.Chunks, enabled: bool
+) -> t.Iterator[t.Tuple[bytes, bool]]:
+    """
+    yields `(data, is_compressed)`. whether to compress is decided by probing -
+    the first chunk.
+    """
+    z = None
+    for chunk in chunks:
+        if z is None:
+            z = enabled and compress_.probe(chunk)
+        yield (compress_.compress(chunk), True) if z else (chunk, False)
+
+
+def prefetch(chunks: T.Chunks, depth: int = PREFETCH) -> t.Iterator[bytes]:
+    """
+    iterate `chunks` in a background thread, keeping at most `depth` chunks -
+    ahead of the consumer.
+    """
+    q = queue.Queue(depth)
+    stopped = threading.Event()
+    error = None
+
+    def put(x: t.Any) -> bool:
+        while not stopped.is_set():
+            try:
+                q.put(x, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce() -> None:
+        nonlocal error
+        try:
+            for x in chunks:
+                if not put(x):
+                    return
+        except BaseException as e:
+            error = e
+        put(_END)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while (x := q.get()) is not _END:
+            yield x
+    finally:
+        stopped.set()
+    if error:
+        raise error
@@ -0,0 +1,119 @@
+"""
+a persistent cache of file content hashes, keyed by (path, size, mtime).
+
+a file is hashed only once as long as its size and mtime don't change. the -
+cache is shared by `doctor.fix_mtime`, conflict checking and move detection -
+in `snapshot.api`.
+
+remote files (air) are hashed on server side, only the digest is sent back.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import typing as t
+from lk_utils import fs as fs0
+
+
+class T:
+    Path = str
+    Digest = str  # md5 hex digest.
+    FileSystem = t.Any
+    #   one of:
+    #       - None or `lk_utils.fs` or `filesys.LocalFileSystem`: local.
+    #       - `filesys2.remote.FileSystem`: hashed on air server.
+    #       - others (`filesys.AirFileSystem`, `filesys.FtpFileSystem`, ...):
+    #         loaded as bytes then hashed locally.
+
+
+class HashCache:
+    def __init__(self, db_file: T.Path = 'data/hash_cache.db') -> None:
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute(
+            'create table if not exists hashes ('
+            '   path text primary key,'
+            '   size integer,'
+            '   mtime integer,'
+            '   digest text'
+            ')'
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, size: int, mtime: int) -> t.Optional[T.Digest]:
+        with self._lock:
+            row = self._conn.execute(
+                'select digest from hashes '
+                'where path = ? and size = ? and mtime = ?',
+                (key, size, mtime),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, size: int, mtime: int, digest: T.Digest) -> None:
+        with self._lock:
+            self._conn.execute(
+                'insert or replace into hashes values (?, ?, ?, ?)',
+                (key, size, mtime, digest),
+            )
+            self._conn.commit()
+
+    def hash_file(
+        self,
+        path: T.Path,
+        mtime: int,
+        size: int = -1,
+        fs: T.FileSystem = None,
+    ) -> T.Digest:
+        """
+        params:
+            size: -1 means unknown, then only mtime is used to validate the -
+                cached digest.
+            fs: which file system `path` belongs to. see `T.FileSystem`.
+        """
+        key = _make_key(path, fs)
+        if digest := self.get(key, size, mtime):
+            return digest
+        digest = _compute_md5(path, fs)
+        self.put(key, size, mtime, digest)
+        return digest
+
+
+_default = None
+
+
+def get_hash_cache() -> HashCache:
+    global _default
+    if _default is None:
+        _default = HashCache()
+    return _default
+
+
+def _compute_md5(path: T.Path, fs: T.FileSystem = None) -> T.Digest:
+    if fs is None or fs is fs0 or type(fs).__name__ == 'LocalFileSystem':
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                md5.update(chunk)
+        return md5.hexdigest()
+    elif hasattr(fs, 'client'):
+        return fs.client.exec(
+            '''
+            import hashlib
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                while chunk := f.read(1024 * 1024):
+                    md5.update(chunk)
+            return md5.hexdigest()
+            ''',
+            path=path,
+        )
+    else:
+        return hashlib.md5(fs.load(path, binary=True)).hexdigest()
+
+
+def _make_key(path: T.Path, fs: T.FileSystem = None) -> str:
+    # remote paths are prefixed with their url, to be distinguished from local
+    # paths and from other devices.
+    if isinstance(url := getattr(fs, 'url', None), str):
+        return url + path
+    return path
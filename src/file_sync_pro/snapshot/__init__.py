@@ -3,4 +3,8 @@ from .api import merge_snapshot
 from .api import rebuild_snapshot
 from .api import sync_snapshot
 from .api import update_snapshot
+from .codec import convert_snapshot
+from .codec import dump_snapshot
+from .codec import load_snapshot
 from .dataclass import Snapshot
+from .watcher import watch_snapshot
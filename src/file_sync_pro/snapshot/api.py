@@ -1,16 +1,30 @@
-import hashlib
-import json
 import os
 import streamlit_canary as sc
 import typing as tp
+from bisect import bisect_left
 from collections import defaultdict
 from lk_utils import fs as fs0
 from lk_utils import timestamp
 from time import time
 from types import ModuleType
 from ..filesys2 import FileSystem
+from ..filesys2 import bundle
 from ..filesys2 import is_local_path
 from ..filesys2.remote import FileSystem as RemoteFileSystem
+from ..hash_cache import get_hash_cache
+from .apply_journal import ApplyJournal
+from .codec import dump_snapshot
+from .codec import load_snapshot
+from .diff_engine import diff_nodes
+from .executor import DirMaker
+from .executor import ThreadLocalFs
+from .executor import TransferExecutor
+from .executor import default_workers
+from .merkle import build_hashes
+from .merkle import changed_keys
+from .merkle import root_hash
+from .merkle import update_hashes
+from .pipeline import PlanStream
 
 
 class T:
@@ -33,7 +47,7 @@ class T:
     #   <=  overwrite to left
     #   <-  delete to left
     #   <~  move to left
-    #   ==  no change
+    #   ==  no change, same file on both sides. only recorded in base.
     Time = int
 
     ComposedAction = tp.Union[
@@ -41,12 +55,33 @@ class T:
         tp.Tuple[tp.Tuple[Key, Key], tp.Literal['~>', '<~'], Time],
     ]
     Nodes = tp.Dict[Path, int]  # {relpath: modified_time, ...}
+    Stats = tp.Dict[Path, tp.List[int]]
+    #   {relpath: [size] | [size, dev, inode], ...}
+    #   see `../filesys2/local.py : make_stat`.
 
     SnapshotItem = tp.TypedDict(
         'SnapshotItem',
         {
             'version': str,  # `<hash>-<time>`
+            #   the hash is root hash of `hashes`.
             'files': Nodes,
+            'stats': Stats,
+            #   this field is optional, old snapshots don't have it, and a file
+            #   may be absent from it (unknown stat).
+            #   the "base" item has only sizes, since inodes are different on
+            #   two sides.
+            'dirs': Nodes,
+            #   this field is optional, only the "current" item has it.
+            #   `{dir_relpath: modified_time, ...}`, it is used by
+            #   `update_snapshot` to skip rescanning unchanged directories.
+            'hashes': tp.Dict[Path, str],
+            #   this field is optional, old snapshots don't have it.
+            #   `{dir_relpath: hex_digest, ...}`, per-directory hashes of
+            #   `files`, root dir is ''. see `merkle.py`.
+            'journal': str,
+            #   this field is optional, only for remote root. it is the token
+            #   from the change journal of air server, see
+            #   `../filesys2/journal.py`.
         },
     )
 
@@ -57,6 +92,8 @@ class T:
             'ignores': tp.Union[tp.List[Path], tp.Tuple[Path, ...]],
             #   this field is optional.
             #   this field is filled by user with manual edit.
+            #   items are relpath prefixes or glob patterns, see
+            #   `../filesys2/ignores.py`.
             #   `tp.List[Path]` is used for serializing to the json file.
             #   `tp.Tuple[Path, ...]` is used in the runtime. see also
             #   `../filesys2/specific.py : FileSystem : findall_nodes : [param]
@@ -72,39 +109,109 @@ def create_snapshot(snap_file: T.AnyPath, source_root: str) -> None:
     params:
         snap_file: can be inexistent file. if exists, will be overwritten.
             usually saved in `data/snapshots/<host>/<name>.json`.
+            use ".fsnap" extension for the compact binary format, or ".db" -
+            for sqlite, see `codec.py`.
     """
     assert is_local_path(snap_file)
     fs1 = FileSystem(source_root)
     root = fs1.root
     del source_root
 
-    files = fs1.findall_nodes(root)
+    files, dirs, stats, _ = fs1.findall_tree(root)
+    files, stats = _sort_nodes(files, stats)
+    # hashes only take sizes from stats, so base and current share them.
+    hashes = build_hashes(files, stats)
     full_data = {'root': fs1.url, 'ignores': []}  # noqa
-    full_data['current'] = full_data['base'] = {
-        'version': _make_version(files),
+    full_data['base'] = {
+        'version': (ver := _make_version(hashes)),
         'files': files,
+        'stats': {k: v[:1] for k, v in stats.items()},
+        'hashes': hashes,
     }
-    fs0.dump(full_data, snap_file)
+    full_data['current'] = {
+        'version': ver,
+        'files': files,
+        'stats': stats,
+        'dirs': dirs,
+        'hashes': hashes,
+    }
+    dump_snapshot(full_data, snap_file)
 
 
 def rebuild_snapshot(snap_file: T.AnyPath):
     # assert fs0.exist(snap_file)
-    create_snapshot(snap_file, fs0.load(snap_file)['root'])
+    create_snapshot(snap_file, load_snapshot(snap_file)['root'])
 
 
-def update_snapshot(snap_file: T.AnyPath, addr=''):
-    full_data = fs0.load(snap_file)
+def update_snapshot(
+    snap_file: T.AnyPath,
+    addr='',
+    full_scan: bool = False,
+    reuse_dirs: bool = False,
+) -> float:
+    """
+    params:
+        full_scan (-f): for remote root, bypass the change journal of air -
+            server and scan the tree. every directory is rescanned, -
+            `reuse_dirs` is ignored.
+        reuse_dirs (-r): reuse the files of directories whose mtime is -
+            unchanged from the last snapshot, instead of stat'ing them -
+            again. this is faster on slow disks and links, but a file -
+            modified in place (logs, databases) doesn't change the mtime of -
+            its parent directory, so its change is missed.
+    returns: reuse ratio (0.0 ~ 1.0) of files from the last snapshot.
+    """
+    full_data = load_snapshot(snap_file)
     fs1 = FileSystem(full_data['root'], addr)
     root = fs1.root
 
-    changed_files = fs1.findall_nodes(
-        root, exclusion=tuple(full_data.get('ignores', ()))
+    exclusion = tuple(full_data.get('ignores', ()))
+    if fs1.is_remote and not full_scan:
+        # copy the maps, they are updated in place but the old ones are
+        # needed to update hashes.
+        stats = dict(full_data['current'].get('stats', {}))
+        result = fs1.fetch_tree_changes(
+            root,
+            dict(full_data['current']['files']),
+            full_data['current'].get('journal', ''),
+            exclusion,
+            stats,
+        )
+        if result:
+            changed_files, dirs, token, reuse_ratio = result
+            changed_files, stats = _sort_nodes(changed_files, stats)
+            hashes = _make_hashes(changed_files, stats, full_data['current'])
+            full_data['current'] = {
+                'version': _make_version(hashes),
+                'files': changed_files,
+                'stats': stats,
+                'dirs': dirs,
+                'hashes': hashes,
+                'journal': token,
+            }
+            dump_snapshot(full_data, snap_file)
+            return reuse_ratio
+        # else the server has no change journal, scan the tree instead.
+
+    history = (
+        full_data['current']['files'],
+        full_data['current'].get('dirs', {}),
+        full_data['current'].get('stats', {}),
     )
+    changed_files, dirs, stats, reuse_ratio = fs1.findall_tree(
+        root, history, exclusion, reuse_dirs and not full_scan
+    )
+    changed_files, stats = _sort_nodes(changed_files, stats)
+    hashes = _make_hashes(changed_files, stats, full_data['current'])
     full_data['current'] = {
-        'version': _make_version(changed_files),
+        'version': _make_version(hashes),
         'files': changed_files,
+        'stats': stats,
+        'dirs': dirs,
+        'hashes': hashes,
     }
-    fs0.dump(full_data, snap_file)
+    dump_snapshot(full_data, snap_file)
+    return reuse_ratio
 
 
 def sync_snapshot(
@@ -115,7 +222,13 @@ def sync_snapshot(
     dry_run: bool = False,
     no_doubt: bool = False,
     consider_moving: bool = False,
+    check_content: bool = False,
     manual_select_base_side: tp.Literal['a', 'b', ''] = '',
+    pipelined: bool = False,
+    workers_a: int = 0,
+    workers_b: int = 0,
+    bundle_threshold: int = 64 * 1024,
+    compress: bool = False,
     _preview: tp.Optional[tp.Callable] = None,
     _progress: tp.Optional[sc.Progress] = None,
 ) -> None:
@@ -123,14 +236,46 @@ def sync_snapshot(
     params:
         dry_run (-d):
         consider_moving (-m):
+        check_content (-c):
+            hash the files of conflicts and ambiguous moves (via a persistent -
+            hash cache, see `hash_cache.py`). conflicts of same content are -
+            resolved without backup.
+        pipelined (-p):
+            apply actions while they are being planned, instead of planning -
+            all of them first (see `pipeline.py`). transfers start at once, -
+            and the planned actions waiting in memory are bounded. -
+            the progress total comes from a counting pass over the node -
+            diffs, see `_count_actions`.
+            memory limit: the node diffs of both sides (a dict entry per -
+            changed file) are built in full before streaming, so memory -
+            still grows with the number of changed files, only the plan -
+            doesn't add to it.
+            whole-subtree actions are not collapsed in this mode (see -
+            `_collapse_subtrees`), since that needs the whole plan. it can't -
+            be used with `check_content`, whose remote hashing would share -
+            the connection with transfers.
+        workers_a (-A):
+            max number of actions running at the same time on side a. 0 -
+            means the default of the backend, see -
+            `executor.DEFAULT_WORKERS`.
+        workers_b (-B):
+            the same as `workers_a`, for side b. set both to 1 to run one by -
+            one.
+        bundle_threshold (-t):
+            new files smaller than this (in bytes) are sent in bundles, see -
+            `filesys2.bundle`. 0 to disable.
+        compress (-z):
+            compress transfers on the wire, for slow links. files of already -
+            compressed formats or high entropy are sent as is, see -
+            `filesys2.compress`.
         manual_select_base_side (-b):
             if set, suggest setting 'b'. it means that `snap_file_b` is -
             passive side.
     """
-    snap_alldata_a = fs0.load(snap_file_a)
-    snap_alldata_b = fs0.load(snap_file_b)
+    snap_alldata_a = load_snapshot(snap_file_a)
+    snap_alldata_b = load_snapshot(snap_file_b)
 
-    def select_base_side() -> tp.Tuple[str, T.Nodes]:
+    def select_base_side() -> tp.Tuple[str, T.Nodes, T.Stats, dict]:
         if manual_select_base_side:
             if manual_select_base_side == 'a':
                 base = snap_alldata_a['base']
@@ -153,7 +298,12 @@ def sync_snapshot(
                 case _:
                     raise Exception
         # noinspection PyUnboundLocalVariable
-        return base['version'], base['files']
+        return (
+            base['version'],
+            base['files'],
+            base.get('stats', {}),
+            base.get('hashes'),
+        )
 
     def compare_version(ver_a: str, ver_b: str) -> int:
         """
@@ -168,37 +318,39 @@ def sync_snapshot(
         else:
             return 2
 
-    snap_ver_base, snap_data_base = select_base_side()
+    snap_ver_base, snap_data_base, stats_base, hashes_base = (
+        select_base_side()
+    )
     snap_data_a = snap_alldata_a['current']['files']
     snap_data_b = snap_alldata_b['current']['files']
+    stats_a = snap_alldata_a['current'].get('stats', {})
+    stats_b = snap_alldata_b['current'].get('stats', {})
 
     # -------------------------------------------------------------------------
 
-    # noinspection PyTypeChecker
     def compare_new_to_old(
-        snap_new: T.Nodes, snap_old: T.Nodes
-    ) -> tp.Iterator[T.ComposedAction]:
+        snap_new: T.Nodes,
+        snap_old: T.Nodes,
+        stats_new: T.Stats,
+        stats_old: T.Stats,
+        hashes_new: tp.Optional[dict] = None,
+        hashes_old: tp.Optional[dict] = None,
+    ) -> tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]]:
         """
-        note: the yieled movement can only be the following:
+        params:
+            hashes_new, hashes_old: if both given, only dirs whose hashes -
+                differ are compared, see `merkle.changed_keys`.
+        note: the movement can only be the following:
             '+>', '=>', '->'.
+            see `diff_engine.diff_nodes`.
         """
-        for k, time_new in snap_new.items():
-            if k in snap_old:
-                time_old = snap_old[k]
-                # assert time_new >= time_old, k
-                # if time_new > time_old:
-                #     yield k, '=>', time_new
-                if time_new > time_old:
-                    yield k, '=>', time_new
-                elif time_new < time_old:
-                    if not k.endswith('/'):
-                        print(':v5i', k, time_new, time_old)
-                        # yield k, '<=?', time_old
-            else:
-                yield k, '+>', time_new
-        for k, time_old in snap_old.items():
-            if k not in snap_new:
-                yield k, '->', time_old
+        if hashes_new and hashes_old:
+            keys_new, keys_old = changed_keys(
+                snap_new, snap_old, hashes_new, hashes_old
+            )
+            snap_new, stats_new = _pick(keys_new, snap_new, stats_new)
+            snap_old, stats_old = _pick(keys_old, snap_old, stats_old)
+        return diff_nodes(snap_new, snap_old, stats_new, stats_old)
 
     changes_a = (
         {}
@@ -207,10 +359,14 @@ def sync_snapshot(
             snap_ver_base,
         )
         == 0
-        else {
-            k: (m, t)
-            for k, m, t in compare_new_to_old(snap_data_a, snap_data_base)
-        }
+        else compare_new_to_old(
+            snap_data_a,
+            snap_data_base,
+            stats_a,
+            stats_base,
+            snap_alldata_a['current'].get('hashes'),
+            hashes_base,
+        )
     )
     changes_b = (
         {}
@@ -219,15 +375,65 @@ def sync_snapshot(
             snap_ver_base,
         )
         == 0
-        else {
-            k: (m, t)
-            for k, m, t in compare_new_to_old(snap_data_b, snap_data_base)
-        }
+        else compare_new_to_old(
+            snap_data_b,
+            snap_data_base,
+            stats_b,
+            stats_base,
+            snap_alldata_b['current'].get('hashes'),
+            hashes_base,
+        )
     )
 
-    final_changes = tuple(
-        _compare_changelists(changes_a, changes_b, no_doubt, consider_moving)
-    )
+    if check_content or not dry_run:
+        fs_a = FileSystem(snap_alldata_a['root'], source_addr_a)
+        fs_b = FileSystem(snap_alldata_b['root'], source_addr_b)
+
+    if check_content:
+        hash_cache = get_hash_cache()
+
+        def content_hash(side: str, key: T.Key) -> tp.Optional[str]:
+            if side == 'a':
+                files, stats, fs = snap_data_a, stats_a, fs_a
+            else:
+                files, stats, fs = snap_data_b, stats_b, fs_b
+            if key not in files or key.endswith('/'):
+                return None
+            size = _size_of(stats, key)
+            return hash_cache.hash_file(
+                '{}/{}'.format(fs.root, key),
+                files[key],
+                -1 if size is None else size,
+                fs.core,
+            )
+    else:
+        content_hash = None
+
+    def plan() -> tp.Iterator[T.ComposedAction]:
+        return _compare_changelists(
+            changes_a,
+            changes_b,
+            no_doubt,
+            consider_moving,
+            (stats_base, stats_a, stats_b),
+            content_hash,
+            (snap_data_base, snap_data_a, snap_data_b),
+        )
+
+    if pipelined and not dry_run:
+        assert not check_content, (
+            '`pipelined` cannot be used with `check_content`'
+        )
+        final_changes = PlanStream(
+            plan, total=_count_actions(changes_a, changes_b)
+        )
+        # the planner threads still read the base node map, apply changes to
+        # a copy of it.
+        snap_data_base = dict(snap_data_base)
+    else:
+        final_changes = tuple(_collapse_subtrees(
+            plan(), (snap_data_base, snap_data_a, snap_data_b)
+        ))
 
     if dry_run:
         if _preview:
@@ -235,22 +441,45 @@ def sync_snapshot(
         else:
             _preview_changes(final_changes)
     else:
-        fs_a = FileSystem(snap_alldata_a['root'], source_addr_a)
-        fs_b = FileSystem(snap_alldata_b['root'], source_addr_b)
-        snap_data_new = _apply_changes(
-            final_changes,
-            snap_data_base,
-            snap_data_a,
-            snap_data_b,
-            fs_a.core,
-            fs_b.core,
-            fs_a.root,
-            fs_b.root,
-            progress=_progress,
-        )
-        print(':v3', 'lock snapshot')
-        _lock_snapshot(snap_alldata_a, snap_data_new, snap_file_a)
-        _lock_snapshot(snap_alldata_b, snap_data_new, snap_file_b)
+        journal = ApplyJournal(snap_file_a, snap_file_b, snap_ver_base)
+        journal.open()
+        try:
+            # noinspection PyUnboundLocalVariable
+            snap_data_new = _apply_changes(
+                final_changes,
+                snap_data_base,
+                snap_data_a,
+                snap_data_b,
+                fs_a.core,
+                fs_b.core,
+                fs_a.root,
+                fs_b.root,
+                progress=_progress,
+                journal=journal,
+                workers=(
+                    workers_a or default_workers(fs_a.core),
+                    workers_b or default_workers(fs_b.core),
+                ),
+                stats=(stats_a, stats_b),
+                bundle_threshold=bundle_threshold,
+                compress=compress,
+            )
+            stats_new = _merge_stats(
+                snap_data_new, (snap_data_a, stats_a), (snap_data_b, stats_b)
+            )
+            print(':v3', 'lock snapshot')
+            _lock_snapshot(
+                snap_alldata_a, snap_data_new, snap_file_a, stats_new
+            )
+            _lock_snapshot(
+                snap_alldata_b, snap_data_new, snap_file_b, stats_new
+            )
+        except BaseException:
+            journal.close()
+            print(':v6', 'sync interrupted, run it again to resume')
+            raise
+        else:
+            journal.close(remove=True)
 
 
 def merge_snapshot(
@@ -265,8 +494,8 @@ def merge_snapshot(
     params:
         dry_run (-d):
     """
-    snap_alldata_a = fs0.load(snap_file_a)
-    snap_alldata_b = fs0.load(snap_file_b)
+    snap_alldata_a = load_snapshot(snap_file_a)
+    snap_alldata_b = load_snapshot(snap_file_b)
 
     files_a = frozenset(snap_alldata_a['current']['files'].keys())
     files_b = frozenset(snap_alldata_b['current']['files'].keys())
@@ -279,7 +508,14 @@ def merge_snapshot(
         for k in (files_b - files_a)
     }
     # noinspection PyTypeChecker
-    final_changes = _compare_changelists(changes_a, changes_b, no_doubt)
+    final_changes = _collapse_subtrees(
+        _compare_changelists(changes_a, changes_b, no_doubt),
+        (
+            {},
+            snap_alldata_a['current']['files'],
+            snap_alldata_b['current']['files'],
+        ),
+    )
 
     if dry_run:
         _preview_changes(final_changes)
@@ -296,28 +532,106 @@ def merge_snapshot(
             fs_a.root,
             fs_b.root,
         )
+        stats_new = _merge_stats(
+            snap_data_new,
+            (
+                snap_alldata_a['current']['files'],
+                snap_alldata_a['current'].get('stats', {}),
+            ),
+            (
+                snap_alldata_b['current']['files'],
+                snap_alldata_b['current'].get('stats', {}),
+            ),
+        )
         print(':v3', 'lock snapshot')
-        _lock_snapshot(snap_alldata_a, snap_data_new, snap_file_a)
-        _lock_snapshot(snap_alldata_b, snap_data_new, snap_file_b)
+        _lock_snapshot(snap_alldata_a, snap_data_new, snap_file_a, stats_new)
+        _lock_snapshot(snap_alldata_b, snap_data_new, snap_file_b, stats_new)
 
 
 # noinspection PyTypeChecker
+def _count_actions(
+    changes_a: tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]],
+    changes_b: tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]],
+) -> int:
+    """
+    count the actions `_compare_changelists` yields, in one pass of dict -
+    lookups, without planning.
+    each changed key gives one action, except keys deleted on both sides, -
+    which give none. the count is exact unless moves are considered, then -
+    it is an upper bound (a move is one action of two keys).
+    """
+    n = len(changes_b)
+    for k, (ma, _) in changes_a.items():
+        if (x := changes_b.get(k)) is None:
+            n += 1
+        elif ma == '->' and x[0] == '->':
+            n -= 1
+    return n
+
+
 def _compare_changelists(
     changes_a: tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]],
     changes_b: tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]],
     no_doubt: bool = False,
     consider_moving: bool = False,
+    stats: tp.Optional[tp.Tuple[T.Stats, T.Stats, T.Stats]] = None,
+    content_hash: tp.Optional[
+        tp.Callable[[str, T.Key], tp.Optional[str]]
+    ] = None,
+    trees: tp.Optional[tp.Tuple[T.Nodes, T.Nodes, T.Nodes]] = None,
 ) -> tp.Iterator[T.ComposedAction]:
+    """
+    params:
+        stats: (stats_base, stats_a, stats_b). if given, sizes are used to -
+            reject false "moved" matches, and to skip conflicts of files -
+            which have same mtime and size on both sides.
+        content_hash: `(side, key) -> digest or None`, side is 'a' or 'b'.
+            if given, it is used to pick the right one from ambiguous -
+            "moved" matches, and to tell if a conflict is real.
+        trees: (files_base, files_a, files_b). if given, renamed dirs are -
+            detected as a whole (see `_find_dir_moves`), and yielded as one -
+            movement with dir keys, e.g. `(('new/', 'old/'), '~>', time)`.
+    """
+    stats_base, stats_a, stats_b = stats or ({}, {}, {})
+
+    def is_same_content(k: T.Key) -> bool:
+        if content_hash is None:
+            return False
+        if _size_of(stats_a, k) != _size_of(stats_b, k) and (
+            k in stats_a and k in stats_b
+        ):
+            return False
+        hash_a = content_hash('a', k)
+        return hash_a is not None and hash_a == content_hash('b', k)
 
     if consider_moving:
         moved_keys = []
 
-        def check_moving(changes_p: dict):
+        if trees:
+            for side, changes_p, changes_q, files_p, stats_p, arrow in (
+                ('a', changes_a, changes_b, trees[1], stats_a, '~>'),
+                ('b', changes_b, changes_a, trees[2], stats_b, '<~'),
+            ):
+                for (dst, src), t, keys in _find_dir_moves(
+                    changes_p, changes_q, trees[0], files_p, stats_base, stats_p
+                ):
+                    print(':v2', 'dir moved ({}): {} -> {} ({} files)'.format(
+                        side, src, dst, len(keys) // 2
+                    ))
+                    moved_keys.extend(keys)
+                    yield (dst, src), arrow, t
+        dir_moved_keys = frozenset(moved_keys)
+
+        def check_moving(changes_p: dict, stats_p: T.Stats, side: str):
             minus_arrowed_items = defaultdict(list)
-            #   {(name, time): [relpath, ...], ...}
+            #   {(name, time): [(relpath, size), ...], ...}
             for k, (m, t) in changes_p.items():
+                if k in dir_moved_keys:
+                    continue
                 if m == '->':
-                    minus_arrowed_items[(k.rsplit('/', 1)[-1], t)].append(k)
+                    minus_arrowed_items[(k.rsplit('/', 1)[-1], t)].append(
+                        (k, _size_of(stats_base, k))
+                    )
             if not minus_arrowed_items:
                 print('no moved items')
                 return
@@ -343,17 +657,32 @@ def _compare_changelists(
             #     raise Exception('test failed: key not in "+>" list')
 
             for k, (m, t) in changes_p.items():
-                if m == '+>':
+                if m == '+>' and k not in dir_moved_keys:
                     if (x := (k.rsplit('/', 1)[-1], t)) in minus_arrowed_items:
-                        y = minus_arrowed_items[x]
+                        size = _size_of(stats_p, k)
+                        y = [
+                            z
+                            for z, s in minus_arrowed_items[x]
+                            if size is None or s is None or s == size
+                        ]
+                        if len(y) > 1 and content_hash:
+                            # the deleted file still exists on the other side.
+                            other = 'b' if side == 'a' else 'a'
+                            digest = content_hash(side, k)
+                            y = [
+                                z for z in y
+                                if digest and content_hash(other, z) == digest
+                            ]
                         if len(y) == 1:
                             z = y[0]
                             moved_keys.append(k)
                             moved_keys.append(z)
                             yield (k, z), '~>', t
 
-        yield from check_moving(changes_a)
-        yield from ((x[0], '<~', x[2]) for x in check_moving(changes_b))
+        yield from check_moving(changes_a, stats_a, 'a')
+        yield from (
+            (x[0], '<~', x[2]) for x in check_moving(changes_b, stats_b, 'b')
+        )
         resolved_moved_keys = frozenset(moved_keys)
     else:
         resolved_moved_keys = None
@@ -367,18 +696,30 @@ def _compare_changelists(
                 if mb == '+>' or mb == '=>':
                     if ta > tb:
                         # b created/updated -> a created/updated
-                        if no_doubt:
+                        if no_doubt or is_same_content(k):
                             yield k, '=>', ta
                         else:
                             yield k, '=>?', ta
                     elif ta == tb:
-                        if no_doubt:
-                            pass
+                        if (
+                            no_doubt
+                            or (
+                                k in stats_a
+                                and k in stats_b
+                                and _size_of(stats_a, k) == _size_of(stats_b, k)
+                            )
+                            or is_same_content(k)
+                        ):
+                            # same mtime and same size (or content), they are
+                            # considered the same file. nothing to transfer,
+                            # but it must be recorded in base, otherwise a
+                            # later delete on one side would be undone.
+                            yield k, '==', ta
                         else:
                             yield k, '=>?', ta
                     else:  # ta < tb
                         # a created/updated -> b created/updated
-                        if no_doubt:
+                        if no_doubt or is_same_content(k):
                             yield k, '<=', tb
                         else:
                             yield k, '<=?', tb
@@ -409,11 +750,174 @@ def _compare_changelists(
                 yield k, '<-', tb
 
 
+def _find_dir_moves(
+    changes_p: tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]],
+    changes_q: tp.Dict[T.Key, tp.Tuple[T.Movement, T.Time]],
+    files_base: T.Nodes,
+    files_p: T.Nodes,
+    stats_base: T.Stats,
+    stats_p: T.Stats,
+) -> tp.Iterator[tp.Tuple[tp.Tuple[T.Key, T.Key], T.Time, tp.List[T.Key]]]:
+    """
+    find dirs renamed on side p: a dir whose files are all deleted, and a new -
+    dir whose files are all added, with the same shape (relpaths under the -
+    dir, mtimes, and sizes if known).
+    the other side (q) must have no change under both dirs, so the rename can -
+    be replayed on it by one `os.rename`.
+    
+    yields: `((dst + '/', src + '/'), max_time, [involved keys])`
+    """
+    deleted = {k: t for k, (m, t) in changes_p.items() if m == '->'}
+    added = {k: t for k, (m, t) in changes_p.items() if m == '+>'}
+    if not deleted or not added:
+        return
+
+    def shape_of(nodes: T.Nodes, stats: T.Stats, d: str) -> tuple:
+        n = len(d) + 1
+        return tuple(sorted(
+            (k[n:], t, _size_of(stats, k))
+            for k, t in nodes.items() if k.startswith(d + '/')
+        ))
+
+    base_keys = sorted(files_base)
+    p_keys = sorted(files_p)
+    busy_q = _count_by_dir(changes_q)
+
+    # dirs wholly deleted / wholly added on side p.
+    del_count = _count_by_dir(deleted)
+    src_dirs = [
+        d for d, n in del_count.items()
+        if n == _count_under(base_keys, d)
+        and _count_under(p_keys, d) == 0
+        and d not in busy_q
+    ]
+    src_dirs = [  # keep only the top ones.
+        d for d in src_dirs
+        if not any(d.startswith(x + '/') for x in src_dirs)
+    ]
+    add_count = _count_by_dir(added)
+    dst_candidates = defaultdict(list)  # {file_count: [dir, ...]}
+    for d, n in add_count.items():
+        if n == _count_under(p_keys, d) and d not in busy_q:
+            if _count_under(base_keys, d) == 0:
+                dst_candidates[n].append(d)
+
+    used = set()
+    for src in src_dirs:
+        n = del_count[src]
+        if not dst_candidates.get(n):
+            continue
+        shape = shape_of(deleted, stats_base, src)
+        matched = []
+        for dst in dst_candidates[n]:
+            if dst in used:
+                continue
+            other = shape_of(added, stats_p, dst)
+            if len(other) == len(shape) and all(
+                x[:2] == y[:2]
+                and (x[2] is None or y[2] is None or x[2] == y[2])
+                for x, y in zip(shape, other)
+            ):
+                matched.append(dst)
+        if len(matched) != 1:
+            continue
+        dst = matched[0]
+        used.add(dst)
+        keys = [k for k in deleted if k.startswith(src + '/')]
+        keys.extend(k for k in added if k.startswith(dst + '/'))
+        yield (dst + '/', src + '/'), max(added[k] for k in keys if (
+            k in added
+        )), keys
+
+
+def _collapse_subtrees(
+    changes: tp.Iterable[T.ComposedAction],
+    trees: tp.Tuple[T.Nodes, T.Nodes, T.Nodes],
+    min_count: int = 2,
+) -> tp.List[T.ComposedAction]:
+    """
+    merge the actions of a wholly added or wholly deleted dir into one -
+    tree-level action, keyed by the dir with a trailing slash, e.g.
+        ('cache/a.tmp', '->', t1), ('cache/b/c.tmp', '->', t2), ...
+        -> ('cache/', '->', max(t1, t2, ...))
+    `_apply_changes` does a tree-level delete by removing the listed files -
+    and then the emptied dirs in one round trip, and a tree-level add by a -
+    bulk subtree copy.
+    
+    params:
+        trees: (files_base, files_a, files_b)
+        min_count: dirs with fewer files are left as is.
+    """
+    changes = list(changes)
+    _, files_a, files_b = trees
+    keys_a = sorted(files_a)
+    keys_b = sorted(files_b)
+    # a dir is wholly added/deleted if all files under it on one side are -
+    # in the same kind of action, and there is nothing under it on the other -
+    # side.
+    #   {movement: (keys of the side where files exist, keys of the other)}
+    sides = {
+        '+>': (keys_a, keys_b),
+        '<+': (keys_b, keys_a),
+        '->': (keys_b, keys_a),
+        '<-': (keys_a, keys_b),
+    }
+    by_movement = defaultdict(list)
+    for k, m, _ in changes:
+        if m in sides and isinstance(k, str) and not k.endswith('/'):
+            by_movement[m].append(k)
+
+    collapsed = {}  # {key: dir}
+    for m, keys in by_movement.items():
+        keys_x, keys_y = sides[m]
+        dirs = [
+            d for d, n in _count_by_dir(keys).items()
+            if n >= min_count
+            and n == _count_under(keys_x, d)
+            and _count_under(keys_y, d) == 0
+        ]
+        if not dirs:
+            continue
+        tops = set()
+        for d in sorted(dirs):  # parents come first.
+            if not any(d.startswith(x + '/') for x in tops):
+                tops.add(d)
+        for k in keys:
+            i = k.find('/')
+            while i != -1:
+                if k[:i] in tops:
+                    collapsed[k] = k[:i] + '/'
+                    break
+                i = k.find('/', i + 1)
+    if not collapsed:
+        return changes
+
+    out = []
+    index = {}  # {(dir, movement): index in out}
+    for k, m, t in changes:
+        if isinstance(k, str) and k in collapsed:
+            d = collapsed[k]
+            if (d, m) in index:
+                i = index[(d, m)]
+                out[i] = (d, m, max(out[i][2], t))
+            else:
+                index[(d, m)] = len(out)
+                out.append((d, m, t))
+        else:
+            out.append((k, m, t))
+    print(':v2', 'collapse {} actions into {} tree-level actions'.format(
+        len(collapsed), len(index)
+    ))
+    return out
+
+
 def _preview_changes(changes: tp.Iterable[T.ComposedAction]) -> None:
     i = 0
     table = [('index', 'left', 'action', 'right')]
     action_count = defaultdict(int)
     for k, m, _ in changes:
+        if m == '==':
+            continue
         i += 1
         colored_key = '[{}]{}[/]'.format(
             'yellow'
@@ -470,7 +974,7 @@ def _preview_changes(changes: tp.Iterable[T.ComposedAction]) -> None:
 
 
 def _apply_changes(
-    changes: tp.Sequence[T.ComposedAction],
+    changes: tp.Union[tp.Sequence[T.ComposedAction], PlanStream],
     snap_data_base: T.Nodes,
     snap_data_a: T.Nodes,
     snap_data_b: T.Nodes,
@@ -479,21 +983,47 @@ def _apply_changes(
     root_a: str,
     root_b: str,
     progress: tp.Optional[sc.Progress] = None,
+    journal: tp.Optional[ApplyJournal] = None,
+    workers: tp.Tuple[int, int] = (1, 1),
+    stats: tp.Tuple[T.Stats, T.Stats] = ({}, {}),
+    bundle_threshold: int = 0,
+    compress: bool = False,
 ) -> T.Nodes:
+    """
+    params:
+        journal: if given, actions recorded in it are replayed into the new -
+            node map instead of being done again, and each done action is -
+            recorded into it.
+        workers: (workers_a, workers_b), max number of actions running at -
+            the same time on each side. see `executor.py`.
+        stats: (stats_a, stats_b), sizes of files are taken from them for -
+            bundling.
+        bundle_threshold: '+>' and '<+' of files smaller than this are -
+            grouped into bundles (see `_bundle_small_files`). 0 to disable.
+        compress: compress transfers on the wire if worthwhile, see -
+            `filesys2.compress`.
+    """
     print(root_a, root_b, ':li0')
 
-    _created_dirs_a = set()
-    for p in snap_data_a:
-        d = root_a
-        for x in p.split('/')[:-1]:
-            d += '/' + x
-            _created_dirs_a.add(d)
-    _created_dirs_b = set()
-    for p in snap_data_b:
-        d = root_b
-        for x in p.split('/')[:-1]:
-            d += '/' + x
-            _created_dirs_b.add(d)
+    if max(workers) > 1 and isinstance(fs_b, RemoteFileSystem):
+        # actions of both sides run in the worker threads (side a ones also
+        # call `fs_b`, e.g. '<+' downloads), and one connection can't be
+        # shared between threads. so each thread talks to the air server on
+        # its own connection.
+        fs_b = ThreadLocalFs(fs_b, fs_b.clone)
+
+    # each side has its own `DirMaker`. the calls are looked up at call time,
+    # so that `fs_b` resolves to the connection of the calling thread.
+    dirs_a = DirMaker(
+        lambda d: fs_a.exist(d),
+        lambda d: fs_a.make_dirs(d),
+        _parent_dirs(root_a, snap_data_a),
+    )
+    dirs_b = DirMaker(
+        lambda d: fs_b.exist(d),
+        lambda d: fs_b.make_dirs(d),
+        _parent_dirs(root_b, snap_data_b),
+    )
 
     # def delete_dir_a(dirpath: T.AbsPath) -> None:
     #     if fs_a.exist(dirpath):
@@ -504,32 +1034,22 @@ def _apply_changes(
     #         fs_b.remove_tree(dirpath)
     #
     # def make_dir_a(dirpath: T.AbsPath) -> None:
-    #     if dirpath not in _created_dirs_a:
+    #     if dirpath not in dirs_a.done:
     #         if not fs_a.exist(dirpath):
     #             fs_a.make_dir(dirpath)
-    #         _created_dirs_a.add(dirpath)
+    #         dirs_a.done.add(dirpath)
     #
     # def make_dir_b(dirpath: T.AbsPath) -> None:
-    #     if dirpath not in _created_dirs_b:
+    #     if dirpath not in dirs_b.done:
     #         if not fs_b.exist(dirpath):
     #             fs_b.make_dir(dirpath)
-    #         _created_dirs_b.add(dirpath)
+    #         dirs_b.done.add(dirpath)
 
     def make_dirs_a(filepath: str) -> None:
-        i = filepath.rfind('/')
-        dirpath = filepath[:i]
-        if dirpath not in _created_dirs_a:
-            if not fs_a.exist(dirpath):
-                fs_a.make_dirs(dirpath)
-            _created_dirs_a.add(dirpath)
+        dirs_a.ensure(filepath[:filepath.rfind('/')])
 
     def make_dirs_b(filepath: str) -> None:
-        i = filepath.rfind('/')
-        dirpath = filepath[:i]
-        if dirpath not in _created_dirs_b:
-            if not fs_b.exist(dirpath):
-                fs_b.make_dirs(dirpath)
-            _created_dirs_b.add(dirpath)
+        dirs_b.ensure(filepath[:filepath.rfind('/')])
 
     _conflicts_dir = 'data/conflicts/{}'.format(timestamp('ymd_hns'))
     fs0.make_dir(_conflicts_dir)
@@ -554,6 +1074,83 @@ def _apply_changes(
         if fs_b.exist(file):
             fs_b.remove_file(file)
 
+    # a tree-level delete only removes the files listed in the snapshot, and -
+    # then the dirs left empty. files ignored by the snapshot (e.g. -
+    # `**/node_modules/`) or created after the last scan are kept, along -
+    # with their dirs.
+
+    def delete_tree_a(reldir: T.Path) -> None:
+        files, dirs = _listed_tree(root_a, snap_data_a, reldir)
+        for f in files:
+            if os.path.isfile(f):
+                os.remove(f)
+        for d in dirs:
+            try:
+                os.rmdir(d)
+            except OSError:
+                pass  # not empty, or already removed.
+
+    def delete_tree_b(reldir: T.Path) -> None:
+        files, dirs = _listed_tree(root_b, snap_data_b, reldir)
+        # one round trip for the whole tree.
+        fs_b.client.exec(
+            '''
+            for f in files:
+                if os.path.isfile(f):
+                    os.remove(f)
+            for d in dirs:
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    pass
+            ''',
+            files=files,
+            dirs=dirs,
+        )
+
+    def copy_tree_a2b(reldir: T.Path) -> None:
+        keys = _keys_under(snap_data_a, reldir)
+        # create all dirs in one round trip, instead of checking each file's -
+        # parent.
+        dirs = sorted({
+            '{}/{}'.format(root_b, k.rsplit('/', 1)[0]) for k in keys
+        })
+        fs_b.client.exec(
+            '''
+            for d in dirs:
+                os.makedirs(d, exist_ok=True)
+            ''',
+            dirs=dirs,
+        )
+        dirs_b.add(dirs)
+        for k, _, _ in _bundle_small_files(
+            ((k, '+>', 0) for k in keys), stats, bundle_threshold or 1
+        ):
+            if isinstance(k, tuple):
+                bundle.upload(fs_b.client.exec, root_a, root_b, k, compress)
+            else:
+                # the mtime is set along with the last chunk, no extra round
+                # trip.
+                update_file_a2b(k)
+
+    def copy_tree_b2a(reldir: T.Path) -> None:
+        keys = _keys_under(snap_data_b, reldir)
+        for d in sorted({
+            '{}/{}'.format(root_a, k.rsplit('/', 1)[0]) for k in keys
+        }):
+            dirs_a.ensure(d)
+        for k, _, _ in _bundle_small_files(
+            ((k, '<+', 0) for k in keys), stats, bundle_threshold or 1
+        ):
+            if isinstance(k, tuple):
+                bundle.download(fs_b.client.exec, root_b, root_a, k, compress)
+            else:
+                _download_file(
+                    '{}/{}'.format(root_b, k),
+                    '{}/{}'.format(root_a, k),
+                    snap_data_b[k],
+                )
+
     def move_file_a(relsrc: T.Path, reldst: T.Path) -> None:
         file_i = '{}/{}'.format(root_a, relsrc)
         file_o = '{}/{}'.format(root_a, reldst)
@@ -564,44 +1161,59 @@ def _apply_changes(
         file_o = '{}/{}'.format(root_b, reldst)
         fs_b.move_file(file_i, file_o)
 
-    def update_file_a2b(relpath: T.Path) -> None:
+    def move_dir_a(relsrc: T.Path, reldst: T.Path) -> None:
+        os.rename(
+            '{}/{}'.format(root_a, relsrc.rstrip('/')),
+            '{}/{}'.format(root_a, reldst.rstrip('/')),
+        )
+
+    def move_dir_b(relsrc: T.Path, reldst: T.Path) -> None:
+        # one round trip for the whole dir.
+        fs_b.client.exec(
+            'os.rename(src, dst)',
+            src='{}/{}'.format(root_b, relsrc.rstrip('/')),
+            dst='{}/{}'.format(root_b, reldst.rstrip('/')),
+        )
+
+    def update_file_a2b(relpath: T.Path, delta: bool = False) -> None:
         file_i = '{}/{}'.format(root_a, relpath)
         file_o = '{}/{}'.format(root_b, relpath)
-        _upload_file(file_i, file_o, tp.cast(int, fs0.filetime(file_i)))
+        _upload_file(
+            file_i, file_o, tp.cast(int, fs0.filetime(file_i)), delta
+        )
 
-    def update_file_b2a(relpath: T.Path, mtime: int) -> None:
+    def update_file_b2a(
+        relpath: T.Path, mtime: int, delta: bool = False
+    ) -> None:
         file_i = '{}/{}'.format(root_b, relpath)
         file_o = '{}/{}'.format(root_a, relpath)
-        _download_file(file_i, file_o, mtime)
+        _download_file(file_i, file_o, mtime, delta)
 
-    def _download_file(file_i: T.Path, file_o: T.Path, mtime: T.Time):
-        data = fs_b.load(file_i, 'binary')
-        fs_a.dump(data, file_o, 'binary')
-        os.utime(file_o, (mtime, mtime))
+    # files are streamed in chunks, see `filesys2.transfer`. overwritten -
+    # files are sent by delta, see `filesys2.delta`. both may be compressed, -
+    # see `filesys2.compress`.
 
-    def _upload_file(file_i: T.Path, file_o: T.Path, mtime: T.Time) -> None:
-        data = fs_a.load(file_i, 'binary')
-        fs_b.dump(data, file_o, 'binary')
-        fs_b.client.exec(
-            'os.utime(file, (mtime, mtime))', file=file_o, mtime=mtime
-        )
+    def _download_file(
+        file_i: T.Path, file_o: T.Path, mtime: T.Time, delta: bool = False
+    ) -> None:
+        fs_b.download_file(file_i, file_o, mtime, delta, compress)
+
+    def _upload_file(
+        file_i: T.Path, file_o: T.Path, mtime: T.Time, delta: bool = False
+    ) -> None:
+        fs_b.upload_file(file_i, file_o, mtime, delta, compress)
 
     # snap_new = snap_data_base.copy()
     snap_new: T.Nodes = snap_data_base
 
-    if progress:
-        progress.total = len(changes)
-    for k, m, t in changes:  # noqa
-        # resolve conflict
-        if m.endswith('?'):
-            assert m in ('=>?', '<=?')
-            if m == '=>?':
-                backup_conflict_file_b('{}/{}'.format(root_b, k), t)
-            else:
-                backup_conflict_file_a('{}/{}'.format(root_a, k))
-            m = m[:-1]
-        # assert '?' not in m
+    sources = (snap_data_a, snap_data_b)
+    if journal:
+        for k, m, t in journal.records:
+            _update_node(snap_new, k, m, t, sources)
 
+    if progress and isinstance(changes, tp.Sized):
+        progress.total = len(changes)
+    def show_action(k: T.Key, m: T.Movement) -> None:
         colored_key = '[{}]{}[/]'.format(
             'green'
             if '+' in m
@@ -667,33 +1279,93 @@ def _apply_changes(
                 )
             )
 
-        if m in ('+>', '=>'):
+    def apply_action(k: T.Key, m: T.Movement, t: T.Time) -> None:
+        if m == '==':
+            return  # no I/O, the node is recorded by `_update_node`.
+        # resolve conflict
+        if m.endswith('?'):
+            assert m in ('=>?', '<=?')
+            if m == '=>?':
+                backup_conflict_file_b('{}/{}'.format(root_b, k), t)
+            else:
+                backup_conflict_file_a('{}/{}'.format(root_a, k))
+            m = m[:-1]
+        # assert '?' not in m
+
+        if m == '+>' and isinstance(k, tuple):
+            bundle.upload(fs_b.client.exec, root_a, root_b, k, compress)
+        elif m == '<+' and isinstance(k, tuple):
+            bundle.download(fs_b.client.exec, root_b, root_a, k, compress)
+        elif m == '+>' and k.endswith('/'):
+            copy_tree_a2b(k)
+        elif m in ('+>', '=>'):
             make_dirs_b('{}/{}'.format(root_b, k))
-            update_file_a2b(k)
-            snap_new[k] = t
+            update_file_a2b(k, delta=m == '=>')
+        elif m == '->' and k.endswith('/'):
+            delete_tree_b(k)
         elif m == '->':
             delete_file_b('{}/{}'.format(root_b, k))
-            snap_new.pop(k)
         elif m == '~>':
             ka, kb = k
-            make_dirs_b('{}/{}'.format(root_b, ka))
-            move_file_b(kb, ka)
-            snap_new[ka] = t
+            if ka.endswith('/'):
+                make_dirs_b('{}/{}'.format(root_b, ka.rstrip('/')))
+                move_dir_b(kb, ka)
+            else:
+                make_dirs_b('{}/{}'.format(root_b, ka))
+                move_file_b(kb, ka)
+        elif m == '<+' and k.endswith('/'):
+            copy_tree_b2a(k)
         elif m in ('<+', '<='):
             make_dirs_a('{}/{}'.format(root_a, k))
-            update_file_b2a(k, t)
-            snap_new[k] = t
+            update_file_b2a(k, t, delta=m == '<=')
+        elif m == '<-' and k.endswith('/'):
+            delete_tree_a(k)
         elif m == '<-':
             delete_file_a('{}/{}'.format(root_a, k))
-            snap_new.pop(k)
         elif m == '<~':
             kb, ka = k
-            make_dirs_a('{}/{}'.format(root_a, kb))
-            move_file_a(ka, kb)
-            snap_new[kb] = t
+            if kb.endswith('/'):
+                make_dirs_a('{}/{}'.format(root_a, kb.rstrip('/')))
+                move_dir_a(ka, kb)
+            else:
+                make_dirs_a('{}/{}'.format(root_a, kb))
+                move_file_a(ka, kb)
         else:
             raise Exception(k, m, t)
 
+    def pending() -> tp.Iterator[T.ComposedAction]:
+        for k, m, t in changes:  # noqa
+            if progress and isinstance(changes, PlanStream):
+                # the counted total (an upper bound with moves) is replaced
+                # by the exact one once planning is done.
+                if changes.total not in (None, progress.total):
+                    progress.total = changes.total
+            if journal and journal.is_done(k, m.rstrip('?')):
+                if progress:
+                    progress.update('(done) {}'.format(k))
+                continue
+            if m == '==':
+                if progress:
+                    progress.update('(same) {}'.format(k))
+            else:
+                show_action(k, m.rstrip('?'))
+            yield k, m, t
+
+    if bundle_threshold:
+        actions = _bundle_small_files(pending(), stats, bundle_threshold)
+    else:
+        actions = pending()
+    try:
+        for x in TransferExecutor(*workers).run(actions, apply_action):
+            for k, m, t in _unbundle(x, sources):
+                m = m.rstrip('?')
+                _update_node(snap_new, k, m, t, sources)
+                if journal:
+                    journal.record(k, m, t)
+    finally:
+        if isinstance(fs_b, ThreadLocalFs):
+            fs_b.close()
+
     if fs0.empty(_conflicts_dir):
         fs0.remove_tree(_conflicts_dir)
     else:
@@ -707,21 +1379,263 @@ def _apply_changes(
     return snap_new
 
 
-def _hash_data(data):
-    return hashlib.md5(
-        json.dumps(data, sort_keys=True).encode()
-        #                ~~~~~~~~~~~~~~ recursively sort.
-    ).hexdigest()
+def _bundle_small_files(
+    actions: tp.Iterable[T.ComposedAction],
+    stats: tp.Tuple[T.Stats, T.Stats],
+    threshold: int,
+) -> tp.Iterator[T.ComposedAction]:
+    """
+    group '+>' and '<+' of small files into bundle actions, whose key is a -
+    tuple of relpaths: `((key, ...), movement, max_time)`. see -
+    `filesys2.bundle`.
+    files of unknown size are not bundled.
+    """
+    buffers = {'+>': [], '<+': []}
+    sizes = {'+>': 0, '<+': 0}
+
+    def flush(m: T.Movement) -> T.ComposedAction:
+        keys, times = zip(*buffers[m])
+        buffers[m] = []
+        sizes[m] = 0
+        if len(keys) == 1:
+            return keys[0], m, times[0]
+        return keys, m, max(times)
+
+    for k, m, t in actions:
+        if (
+            m in buffers
+            and isinstance(k, str)
+            and not k.endswith('/')
+            and (size := _size_of(stats[m == '<+'], k)) is not None
+            and size < threshold
+        ):
+            buffers[m].append((k, t))
+            sizes[m] += size
+            if (
+                len(buffers[m]) >= bundle.MAX_COUNT
+                or sizes[m] >= bundle.MAX_BYTES
+            ):
+                yield flush(m)
+        else:
+            yield k, m, t
+    for m in buffers:
+        if buffers[m]:
+            yield flush(m)
 
 
-def _make_version(files_data):
-    return '{}-{}'.format(_hash_data(files_data), int(time()))
+def _unbundle(
+    action: T.ComposedAction, sources: tp.Tuple[T.Nodes, T.Nodes]
+) -> tp.Iterator[T.ComposedAction]:
+    k, m, t = action
+    if m in ('+>', '<+') and isinstance(k, tuple):
+        src = sources[0] if m == '+>' else sources[1]
+        for x in k:
+            yield x, m, src[x]
+    else:
+        yield action
+
+
+def _parent_dirs(root: str, files: T.Nodes) -> tp.Set[T.AbsPath]:
+    out = set()
+    for p in files:
+        d = root
+        for x in p.split('/')[:-1]:
+            d += '/' + x
+            out.add(d)
+    return out
 
 
-def _lock_snapshot(full_data, files_data, output_file):
-    files_data = dict(sorted(files_data.items()))
-    full_data['base'] = full_data['current'] = {
-        'version': _make_version(files_data),
+def _keys_under(files: T.Nodes, reldir: T.Key) -> tp.List[T.Key]:
+    """
+    params:
+        reldir: ends with '/'.
+    """
+    return [k for k in files if k.startswith(reldir)]
+
+
+def _listed_tree(
+    root: str, files: T.Nodes, reldir: T.Key
+) -> tp.Tuple[tp.List[T.AbsPath], tp.List[T.AbsPath]]:
+    """
+    params:
+        reldir: ends with '/'.
+    returns: (files, dirs)
+        files: abspaths of files under `reldir`.
+        dirs: abspaths of their parent dirs up to `reldir` (included), -
+            deepest first, so that they can be removed in order once empty.
+    """
+    keys = _keys_under(files, reldir)
+    dirs = {reldir.rstrip('/')}
+    for k in keys:
+        d = k.rsplit('/', 1)[0]
+        while len(d) >= len(reldir) and d not in dirs:
+            dirs.add(d)
+            d = d.rsplit('/', 1)[0]
+    return (
+        ['{}/{}'.format(root, k) for k in keys],
+        ['{}/{}'.format(root, d) for d in sorted(dirs, reverse=True)],
+    )
+
+
+def _count_by_dir(keys: tp.Iterable[T.Key]) -> tp.Dict[str, int]:
+    """
+    count files under each dir (at any depth).
+    e.g. ['a/b/c.txt', 'a/d.txt'] -> {'a': 2, 'a/b': 1}
+    """
+    out = defaultdict(int)
+    for k in keys:
+        i = k.find('/')
+        while i != -1:
+            out[k[:i]] += 1
+            i = k.find('/', i + 1)
+    return out
+
+
+def _count_under(sorted_keys: tp.List[T.Key], d: str) -> int:
+    # '0' is the next char of '/', all keys under `d/` are before `d0`.
+    return bisect_left(sorted_keys, d + '0') - bisect_left(
+        sorted_keys, d + '/'
+    )
+
+
+def _pick(
+    keys: tp.Iterable[T.Key], files: T.Nodes, stats: T.Stats
+) -> tp.Tuple[T.Nodes, T.Stats]:
+    return (
+        {k: files[k] for k in keys},
+        {k: stats[k] for k in keys if k in stats},
+    )
+
+
+def _sort_nodes(
+    files: T.Nodes, stats: T.Stats
+) -> tp.Tuple[T.Nodes, T.Stats]:
+    """
+    node maps are saved in sorted order, which makes diffing them cheaper -
+    (see `diff_engine.py`).
+    """
+    files = dict(sorted(files.items()))
+    return files, {k: stats[k] for k in files if k in stats}
+
+
+def _update_node(
+    snap_new: T.Nodes,
+    k: T.Key,
+    m: T.Movement,
+    t: T.Time,
+    sources: tp.Tuple[T.Nodes, T.Nodes] = None,
+) -> None:
+    """
+    params:
+        sources: (files_a, files_b), where the files of a tree-level add -
+            (see `_collapse_subtrees`) are taken from.
+    """
+    if m in ('->', '<-') and k.endswith('/'):
+        for x in _keys_under(snap_new, k):
+            snap_new.pop(x)
+    elif m in ('->', '<-'):
+        snap_new.pop(k, None)
+    elif m in ('+>', '<+') and k.endswith('/'):
+        src = sources[0] if m == '+>' else sources[1]
+        for x in _keys_under(src, k):
+            snap_new[x] = src[x]
+    elif m in ('~>', '<~') and k[0].endswith('/'):
+        dst, src = k
+        for x in _keys_under(snap_new, src):
+            snap_new[dst + x[len(src):]] = snap_new.pop(x)
+    elif m in ('~>', '<~'):
+        snap_new[k[0]] = t
+    else:
+        snap_new[k] = t
+
+
+def _make_hashes(
+    files_data: T.Nodes,
+    stats_data: T.Stats,
+    old_item: tp.Optional[T.SnapshotItem] = None,
+) -> tp.Dict[T.Path, str]:
+    """
+    update hashes from `old_item` if it has, otherwise build from scratch.
+    """
+    if old_item and old_item.get('hashes'):
+        return update_hashes(
+            files_data,
+            stats_data,
+            (
+                old_item['files'],
+                old_item.get('stats', {}),
+                old_item['hashes'],
+            ),
+        )
+    return build_hashes(files_data, stats_data)
+
+
+def _make_version(hashes):
+    return '{}-{}'.format(root_hash(hashes), int(time()))
+
+
+def _lock_snapshot(full_data, files_data, output_file, stats_data=None):
+    """
+    params:
+        stats_data: sizes of `files_data`, see `_merge_stats`.
+    """
+    files_data, stats_data = _sort_nodes(files_data, stats_data or {})
+    old_current = full_data['current']
+    own_files = old_current['files']
+    own_stats = old_current.get('stats', {})
+    base_hashes = _make_hashes(files_data, stats_data, full_data['base'])
+    full_data['base'] = {
+        'version': (ver := _make_version(base_hashes)),
+        'files': files_data,
+        'stats': stats_data,
+        'hashes': base_hashes,
+    }
+    current_stats = {}
+    for k, t in files_data.items():
+        # keep own stat (with inode) if the file is not touched by sync.
+        if k in own_stats and own_files.get(k) == t:
+            current_stats[k] = own_stats[k]
+        elif k in stats_data:
+            current_stats[k] = stats_data[k]
+    full_data['current'] = {
+        'version': ver,
         'files': files_data,
+        'stats': current_stats,
+        'dirs': old_current.get('dirs', {}),
+        #   the dirs table is still valid: adding, deleting or moving files
+        #   changes the mtime of their parent dirs, so they will be rescanned
+        #   next time.
+        'hashes': _make_hashes(files_data, current_stats, old_current),
+        #   usually equal to `base_hashes`, unless a file has different sizes
+        #   on two sides (then both sizes are unreliable).
     }
-    fs0.dump(full_data, output_file)
+    if 'journal' in old_current:
+        # the journal has recorded changes made by the sync itself, applying
+        # them to `files_data` again does no harm.
+        full_data['current']['journal'] = old_current['journal']
+    # for ".db" snapshot, only the rows touched by sync are written.
+    dump_snapshot(full_data, output_file)
+
+
+def _merge_stats(
+    files_data: T.Nodes, *sides: tp.Tuple[T.Nodes, T.Stats]
+) -> T.Stats:
+    """
+    after sync, a file has the same size on both sides. take its size from -
+    the side whose mtime matches.
+    
+    params:
+        sides: ((files, stats), ...)
+    returns: `{relpath: [size], ...}`
+    """
+    out = {}
+    for k, t in files_data.items():
+        for files_x, stats_x in sides:
+            if k in stats_x and files_x.get(k) == t:
+                out[k] = stats_x[k][:1]
+                break
+    return out
+
+
+def _size_of(stats: T.Stats, key: T.Key) -> tp.Optional[int]:
+    return stat[0] if (stat := stats.get(key)) else None
@@ -0,0 +1,96 @@
+"""
+a write-ahead journal of completed actions during `sync_snapshot`.
+
+each action is appended to the journal file right after it is done. if the -
+sync is interrupted (e.g. the connection to the phone drops), the next -
+`sync_snapshot` with the same snapshot files finds the journal, replays the -
+recorded actions into the new base node map and skips them, so finished -
+transfers are not redone. the journal is removed once both snapshots are -
+locked.
+
+journal file (json lines), saved in `data/journals/<id>.jsonl`:
+    {"a": <snap_file_a>, "b": <snap_file_b>, "base": <base_version>}
+    [<key>, <movement>, <time>]
+    ...
+"""
+
+import hashlib
+import json
+import os
+import typing as tp
+from lk_utils import fs as fs0
+
+
+class T:
+    AnyPath = str
+    Key = tp.Union[str, tp.Tuple[str, str]]
+    Movement = str
+    Time = int
+    Record = tp.Tuple[Key, Movement, Time]
+
+
+class ApplyJournal:
+    def __init__(
+        self, snap_file_a: T.AnyPath, snap_file_b: T.AnyPath, base_version: str
+    ) -> None:
+        self.header = {
+            'a': fs0.abspath(snap_file_a),
+            'b': fs0.abspath(snap_file_b),
+            'base': base_version,
+        }
+        self.file = 'data/journals/{}.jsonl'.format(
+            hashlib.md5(
+                '{}|{}'.format(self.header['a'], self.header['b']).encode()
+            ).hexdigest()[:12]
+        )
+        self.records: tp.List[T.Record] = self._load()
+        self._done = {(k, m) for k, m, _ in self.records}
+        self._f = None
+
+    def is_done(self, key: T.Key, movement: T.Movement) -> bool:
+        return (key, movement) in self._done
+
+    def open(self) -> None:
+        if not fs0.exist('data/journals'):
+            fs0.make_dirs('data/journals')
+        # rewrite loaded records, in case the last line was partially written.
+        self._f = open(self.file, 'w', encoding='utf-8')
+        self._write(self.header)
+        for r in self.records:
+            self._write(r)
+
+    def record(self, key: T.Key, movement: T.Movement, time: T.Time) -> None:
+        self._write((key, movement, time))
+        self._done.add((key, movement))
+
+    def close(self, remove: bool = False) -> None:
+        if self._f:
+            self._f.close()
+            self._f = None
+        if remove and os.path.exists(self.file):
+            os.remove(self.file)
+
+    def _load(self) -> tp.List[T.Record]:
+        if not os.path.exists(self.file):
+            return []
+        with open(self.file, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        if not lines or json.loads(lines[0]) != self.header:
+            print(':v6', 'discard outdated apply journal: {}'.format(self.file))
+            return []
+        out = []
+        for line in lines[1:]:
+            try:
+                k, m, t = json.loads(line)
+            except ValueError:
+                break  # the last line may be partially written.
+            out.append((tuple(k) if isinstance(k, list) else k, m, t))
+        if out:
+            print(':v3', 'resume from apply journal: {} actions done'.format(
+                len(out)
+            ))
+        return out
+
+    def _write(self, data: tp.Any) -> None:
+        self._f.write(json.dumps(data, ensure_ascii=False) + '\n')
+        self._f.flush()
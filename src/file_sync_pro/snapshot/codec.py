@@ -0,0 +1,223 @@
+"""
+snapshot file codecs, chosen by file extension:
+    .json   pretty-printed json (the default).
+    .gz     gzip compressed compact json, e.g. "xxx.json.gz".
+    .fsnap  compact binary format, see below.
+    .db     sqlite, see `sqlite_store.py`.
+
+the binary format stores each node map (e.g. `current.files`) as a table:
+keys are sorted and prefix-compressed (each key keeps only the part that -
+differs from the previous key), mtimes and stats are packed integer arrays.
+other fields (root, ignores, versions, journal token...) are stored in a -
+small json header.
+
+layout (integers are little-endian):
+    magic           b'FSNAP' + format version (1 byte)
+    header          u32 length + json bytes
+    tables          one per entry in `header['tables']`:
+        count       u32
+        suffixes    u32 length + utf-8 bytes, joined by '\\0'
+        prefixes    u32 * count, shared prefix length (in chars) with the -
+                    previous key
+        mtimes      i64 * count
+        has_stats   u8
+        [if has_stats]
+        stat_lens   u8 * count, number of ints in each stat (0 if none)
+        stat_data   u32 length (number of ints) + i64 * length
+"""
+
+import gzip
+import json
+import struct
+import sys
+import typing as tp
+from array import array
+from lk_utils import fs as fs0
+from os.path import commonprefix
+from . import sqlite_store
+
+
+class T:
+    AnyPath = str
+    FullData = tp.Dict[str, tp.Any]  # see `api.T.SnapshotFull`
+    Nodes = tp.Dict[str, int]
+    Stats = tp.Dict[str, tp.List[int]]
+
+
+_MAGIC = b'FSNAP\x01'
+_TABLES = (
+    # (section, nodes field, stats field)
+    ('base', 'files', 'stats'),
+    ('current', 'files', 'stats'),
+    ('current', 'dirs', None),
+)
+
+
+def load_snapshot(file: T.AnyPath) -> T.FullData:
+    if file.endswith('.fsnap'):
+        with open(file, 'rb') as f:
+            return _decode(f.read())
+    if file.endswith('.db'):
+        return sqlite_store.load(file)
+    if file.endswith('.gz'):
+        with gzip.open(file, 'rb') as f:
+            return json.load(f)
+    return fs0.load(file)
+
+
+def dump_snapshot(full_data: T.FullData, file: T.AnyPath) -> None:
+    if file.endswith('.fsnap'):
+        with open(file, 'wb') as f:
+            f.write(_encode(full_data))
+    elif file.endswith('.db'):
+        sqlite_store.dump(full_data, file)
+    elif file.endswith('.gz'):
+        with gzip.open(file, 'wt', encoding='utf-8') as f:
+            json.dump(full_data, f, ensure_ascii=False, separators=(',', ':'))
+    else:
+        fs0.dump(full_data, file)
+
+
+def convert_snapshot(file_i: T.AnyPath, file_o: T.AnyPath) -> None:
+    """
+    convert a snapshot file between formats, e.g. from ".json" to ".fsnap" -
+    or ".db".
+    the format is decided by file extension.
+    """
+    dump_snapshot(load_snapshot(file_i), file_o)
+    print(':v4', '{} -> {}'.format(file_i, file_o))
+
+
+# -----------------------------------------------------------------------------
+
+
+def _encode(full_data: T.FullData) -> bytes:
+    header = {}
+    tables = []
+    for k, v in full_data.items():
+        header[k] = dict(v) if isinstance(v, dict) else v
+    for section, field, stats_field in _TABLES:
+        if section in header and field in header[section]:
+            nodes = header[section].pop(field)
+            stats = header[section].pop(stats_field, None) if (
+                stats_field
+            ) else None
+            tables.append((section, field, stats_field, nodes, stats))
+    header['tables'] = [
+        (section, field, stats_field if stats is not None else None)
+        for section, field, stats_field, _, stats in tables
+    ]
+
+    out = [_MAGIC]
+    head = json.dumps(header, ensure_ascii=False).encode()
+    out.append(struct.pack('<I', len(head)))
+    out.append(head)
+    for _, _, _, nodes, stats in tables:
+        out.extend(_encode_table(nodes, stats))
+    return b''.join(out)
+
+
+def _decode(data: bytes) -> T.FullData:
+    assert data[:len(_MAGIC)] == _MAGIC, 'not a snapshot file (.fsnap)'
+    pos = len(_MAGIC)
+    (size,) = struct.unpack_from('<I', data, pos)
+    pos += 4
+    full_data = json.loads(data[pos:pos + size])
+    pos += size
+    for section, field, stats_field in full_data.pop('tables'):
+        nodes, stats, pos = _decode_table(data, pos)
+        full_data[section][field] = nodes
+        if stats_field:
+            full_data[section][stats_field] = stats
+    return full_data
+
+
+def _encode_table(
+    nodes: T.Nodes, stats: tp.Optional[T.Stats]
+) -> tp.Iterator[bytes]:
+    keys = sorted(nodes)
+    prefixes = array('I')
+    suffixes = []
+    last = ''
+    for k in keys:
+        # most keys share the whole parent dir with the previous one, check
+        # that first since `commonprefix` is slow.
+        n = k.rfind('/') + 1
+        if k[:n] != last[:n]:
+            n = len(commonprefix((last, k)))
+        prefixes.append(n)
+        suffixes.append(k[n:])
+        last = k
+    mtimes = array('q', (nodes[k] for k in keys))
+    blob = '\0'.join(suffixes).encode()
+
+    yield struct.pack('<II', len(keys), len(blob))
+    yield blob
+    yield _pack(prefixes)
+    yield _pack(mtimes)
+    if stats is None:
+        yield b'\x00'
+    else:
+        stat_lens = array('B')
+        stat_data = array('q')
+        for k in keys:
+            s = stats.get(k, ())
+            stat_lens.append(len(s))
+            stat_data.extend(s)
+        yield b'\x01'
+        yield stat_lens.tobytes()
+        yield struct.pack('<I', len(stat_data))
+        yield _pack(stat_data)
+
+
+def _decode_table(
+    data: bytes, pos: int
+) -> tp.Tuple[T.Nodes, tp.Optional[T.Stats], int]:
+    count, size = struct.unpack_from('<II', data, pos)
+    pos += 8
+    suffixes = data[pos:pos + size].decode().split('\0') if count else []
+    pos += size
+    prefixes, pos = _unpack('I', data, pos, count)
+    mtimes, pos = _unpack('q', data, pos, count)
+
+    keys = []
+    last = ''
+    for n, suffix in zip(prefixes, suffixes):
+        last = last[:n] + suffix
+        keys.append(last)
+    nodes = dict(zip(keys, mtimes))
+
+    has_stats = data[pos]
+    pos += 1
+    if not has_stats:
+        return nodes, None, pos
+    stat_lens = data[pos:pos + count]
+    pos += count
+    (size,) = struct.unpack_from('<I', data, pos)
+    pos += 4
+    stat_data, pos = _unpack('q', data, pos, size)
+    stats = {}
+    i = 0
+    for k, n in zip(keys, stat_lens):
+        if n:
+            stats[k] = stat_data[i:i + n].tolist()
+            i += n
+    return nodes, stats, pos
+
+
+def _pack(arr: array) -> bytes:
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(
+    typecode: str, data: bytes, pos: int, count: int
+) -> tp.Tuple[array, int]:
+    arr = array(typecode)
+    end = pos + count * arr.itemsize
+    arr.frombytes(data[pos:end])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr, end
@@ -1,18 +1,27 @@
 """
 about snapshot file:
-    -   the file extension is ".json".
+    -   the file extension is ".json", or ".json.gz" for gzip compressed.
+        a compressed snapshot is much faster to load/save over air or ftp. -
+        it is decompressed while downloading, and saved by streaming the -
+        compressed json into a local temp file which is then uploaded in -
+        chunks, so the compressed payload is never held in memory as a whole.
     -   the file should be path irrelevant, i.e. you can put it at any position,
         either in local disk, or usb, or mobile sdcard.
 """
 
+import gzip
 import hashlib
 import json
+import os
+import tempfile
 import typing as t
+import zlib
 from lk_utils import fs as lkfs
 from time import time
 from ..filesys import AirFileSystem
 from ..filesys import FtpFileSystem
 from ..filesys import LocalFileSystem
+from ..filesys import PooledFtpFileSystem
 
 
 class T:
@@ -64,13 +73,26 @@ class Snapshot:
     snapshot_file: T.AbsPath
     source_root: T.AbsPath
     
-    def __init__(self, snapshot_file: T.AnyPath) -> None:
-        assert snapshot_file.endswith('.json')
+    def __init__(
+        self, snapshot_file: T.AnyPath, ftp_connections: int = 1
+    ) -> None:
+        """
+        params:
+            ftp_connections: if > 1, an ftp root or snapshot file is opened -
+                with `PooledFtpFileSystem`, which lists directories over this -
+                many connections at the same time. call `close` when done.
+        """
+        assert snapshot_file.endswith(('.json', '.json.gz'))
+        self.is_compressed = snapshot_file.endswith('.gz')
         if snapshot_file.startswith(('air://', 'ftp://')):
             self.is_snapshot_remote = True
             prefix = snapshot_file.split('://', 1)[0]
-            syscls = prefix == 'air' and AirFileSystem or FtpFileSystem
-            self.fs, self.snapshot_file = syscls.create_from_url(snapshot_file)
+            if prefix == 'air':
+                self.fs, self.snapshot_file = \
+                    AirFileSystem.create_from_url(snapshot_file)
+            else:
+                self.fs, self.snapshot_file = \
+                    self._open_ftp(snapshot_file, ftp_connections)
             if self.fs.exist(self.snapshot_file):
                 self.source_root = self.load_snapshot()['root']
                 self.is_root_remote = False
@@ -79,13 +101,16 @@ class Snapshot:
         else:
             self.is_snapshot_remote = False
             if lkfs.exist(snapshot_file):
-                root = lkfs.load(snapshot_file)['root']
+                root = self._load_local(snapshot_file)['root']
                 if root.startswith(('air://', 'ftp://')):
                     self.is_root_remote = True
                     prefix = root.split('://', 1)[0]
-                    syscls = \
-                        {'air': AirFileSystem, 'ftp': FtpFileSystem}[prefix]
-                    self.fs, self.source_root = syscls.create_from_url(root)
+                    if prefix == 'air':
+                        self.fs, self.source_root = \
+                            AirFileSystem.create_from_url(root)
+                    else:
+                        self.fs, self.source_root = \
+                            self._open_ftp(root, ftp_connections)
                     self.snapshot_file = lkfs.abspath(snapshot_file)
                     self.is_snapshot_inside = False
                 else:
@@ -103,12 +128,19 @@ class Snapshot:
         # note: `self.source_root`, `self.is_root_remote` may be undefined if
         # snap file not exists.
     
+    def close(self) -> None:
+        if isinstance(self.fs, FtpFileSystem):
+            self.fs.close()
+    
     def load_snapshot(self, _raw_format: bool = False) -> T.SnapshotFull:
         data: T.SnapshotFull
         if self.is_snapshot_remote:
-            data = json.loads(self.fs.load(self.snapshot_file))
+            if self.is_compressed:
+                data = json.loads(self._load_remote_compressed())
+            else:
+                data = json.loads(self.fs.load(self.snapshot_file))
         else:
-            data = lkfs.load(self.snapshot_file)
+            data = self._load_local(self.snapshot_file)
             if not _raw_format:
                 if data['root'].startswith(('air://', 'ftp://')):
                     data['root'] = '/' + data['root'].split('/', 3)[-1]
@@ -171,11 +203,55 @@ class Snapshot:
         self.save_snapshot(full)
     
     def save_snapshot(self, full_data: T.SnapshotFull):
-        if self.is_snapshot_remote:
+        if self.is_compressed:
+            if self.is_snapshot_remote:
+                fd, tmp = tempfile.mkstemp(suffix='.json.gz')
+                os.close(fd)
+                try:
+                    self._dump_compressed(full_data, tmp)
+                    self.fs.upload_file(tmp, self.snapshot_file)
+                finally:
+                    os.remove(tmp)
+            else:
+                self._dump_compressed(full_data, self.snapshot_file)
+        elif self.is_snapshot_remote:
             self.fs.dump(full_data, self.snapshot_file)
         else:
             lkfs.dump(full_data, self.snapshot_file)
     
+    @staticmethod
+    def _open_ftp(
+        url: str, connections: int
+    ) -> t.Tuple[FtpFileSystem, T.AbsPath]:
+        if connections > 1:
+            return PooledFtpFileSystem.create_from_url(
+                url, connections=connections
+            )
+        return FtpFileSystem.create_from_url(url)
+    
+    @staticmethod
+    def _dump_compressed(full_data: T.SnapshotFull, file: T.Path) -> None:
+        # `json.dump` writes the text piece by piece, and gzip compresses it -
+        # on the fly.
+        with gzip.open(file, 'wt', encoding='utf-8') as f:
+            json.dump(full_data, f, ensure_ascii=False, separators=(',', ':'))
+    
+    def _load_local(self, file: T.Path) -> dict:
+        if self.is_compressed:
+            return json.loads(gzip.decompress(lkfs.load(file, 'binary')))
+        return lkfs.load(file)
+    
+    def _load_remote_compressed(self) -> bytes:
+        decoder = zlib.decompressobj(wbits=31)  # 31: gzip format.
+        chunks = []
+        # both `AirFileSystem` and `FtpFileSystem` pass chunks as they arrive.
+        self.fs.load_chunks(
+            self.snapshot_file,
+            lambda x: chunks.append(decoder.decompress(x)),
+        )
+        chunks.append(decoder.flush())
+        return b''.join(chunks)
+    
     @staticmethod
     def _hash_snapshot(data: T.SnapshotData) -> str:
         return hashlib.md5(
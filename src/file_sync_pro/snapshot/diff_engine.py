@@ -0,0 +1,223 @@
+"""
+diff a node map against its base with a merge-join over sorted arrays.
+
+both maps are turned into sorted key lists with aligned mtime (and size) -
+lists. the join walks them in blocks: a block whose keys and values are -
+equal on both sides is skipped by a list comparison (done in c), only the -
+blocks around a change are walked key by key in python.
+
+node maps are saved in sorted order (see `api._lock_snapshot`), in which -
+case the arrays are taken from dict views directly, without hash lookups.
+
+benchmark:
+    pox -m file_sync_pro.snapshot.diff_engine -h
+"""
+
+import typing as tp
+from argsense import CommandLineInterface
+from operator import itemgetter
+from time import perf_counter
+
+
+class T:
+    Key = str
+    Movement = tp.Literal['+>', '=>', '->']
+    Nodes = tp.Dict[Key, int]
+    Stats = tp.Dict[Key, tp.List[int]]
+    Time = int
+    Changes = tp.Dict[Key, tp.Tuple[Movement, Time]]
+
+
+def diff_nodes(
+    new: T.Nodes,
+    old: T.Nodes,
+    stats_new: T.Stats = None,
+    stats_old: T.Stats = None,
+    block: int = 32,
+    _verbose: bool = True,
+) -> T.Changes:
+    """
+    params:
+        block: number of keys compared at once in the fast path.
+    returns: `{key: (movement, time), ...}`, sorted by key.
+        movement is one of '+>', '=>', '->'.
+        a file is '=>' if its mtime is newer, or its mtime is same but size -
+        differs (both sizes known).
+    """
+    kn, vn = _to_arrays(new)
+    ko, vo = _to_arrays(old)
+    use_sizes = bool(stats_new and stats_old)
+    if use_sizes:
+        zn = _to_sizes(kn, stats_new)
+        zo = _to_sizes(ko, stats_old)
+    else:
+        zn = zo = None
+
+    out = {}
+
+    def compare(a: int, b: int) -> None:
+        k, t, t0 = kn[a], vn[a], vo[b]
+        if t > t0:
+            out[k] = ('=>', t)
+        elif t < t0:
+            if _verbose and not k.endswith('/'):
+                print(':v5i', k, t, t0)
+        elif use_sizes:
+            x, y = zn[a], zo[b]
+            if x is not None and y is not None and x != y:
+                # same mtime but different size, the mtime must have been
+                # kept by the tool that modified it.
+                out[k] = ('=>', t)
+
+    i = j = 0
+    len_n, len_o = len(kn), len(ko)
+    while i < len_n and j < len_o:
+        e, f = i + block, j + block
+        if kn[i:e] == ko[j:f]:
+            if vn[i:e] != vo[j:f] or (use_sizes and zn[i:e] != zo[j:f]):
+                for a in range(i, min(e, len_n)):
+                    compare(a, a - i + j)
+            i, j = e, f
+            continue
+        for _ in range(block):
+            if i >= len_n or j >= len_o:
+                break
+            a, b = kn[i], ko[j]
+            if a == b:
+                compare(i, j)
+                i += 1
+                j += 1
+            elif a < b:
+                out[a] = ('+>', vn[i])
+                i += 1
+            else:
+                out[b] = ('->', vo[j])
+                j += 1
+    for a in range(i, len_n):
+        out[kn[a]] = ('+>', vn[a])
+    for b in range(j, len_o):
+        out[ko[b]] = ('->', vo[b])
+    return dict(sorted(out.items()))
+
+
+def _to_arrays(nodes: T.Nodes) -> tp.Tuple[tp.List[T.Key], tp.List[T.Time]]:
+    keys = list(nodes)
+    sorted_keys = sorted(keys)
+    if keys == sorted_keys:
+        return keys, list(nodes.values())
+    return sorted_keys, list(map(nodes.__getitem__, sorted_keys))
+
+
+def _to_sizes(
+    sorted_keys: tp.List[T.Key], stats: T.Stats
+) -> tp.List[tp.Optional[int]]:
+    if len(stats) == len(sorted_keys) and list(stats) == sorted_keys:
+        return list(map(itemgetter(0), stats.values()))
+    sizes = dict(zip(stats.keys(), map(itemgetter(0), stats.values())))
+    return list(map(sizes.get, sorted_keys))
+
+
+# -----------------------------------------------------------------------------
+
+# a cli of its own, so that importing this module doesn't add `benchmark` to -
+# the commands of `file_sync_pro`.
+_cli = CommandLineInterface('diff_engine')
+
+
+@_cli
+def benchmark(
+    sizes: str = '10000,100000,1000000', change_ratio: float = 0.01
+) -> None:
+    """
+    compare `diff_nodes` with the per-key loop (which `sync_snapshot` used -
+    before) on synthetic snapshots.
+
+    params:
+        sizes (-s): comma separated entry counts.
+        change_ratio (-r): ratio of added, modified and deleted files, each.
+    """
+    rows = [('entries', 'changes', 'per-key loop', 'diff_nodes', 'speedup')]
+    for n in map(int, sizes.split(',')):
+        old, new, stats_old, stats_new = _make_samples(n, change_ratio)
+
+        start = perf_counter()
+        expected = dict(sorted(
+            _per_key_diff(new, old, stats_new, stats_old).items()
+        ))
+        t0 = perf_counter() - start
+
+        start = perf_counter()
+        result = diff_nodes(new, old, stats_new, stats_old, _verbose=False)
+        t1 = perf_counter() - start
+
+        assert result == expected
+        rows.append((
+            str(n),
+            str(len(result)),
+            '{:.3f}s'.format(t0),
+            '{:.3f}s'.format(t1),
+            '{:.1f}x'.format(t0 / t1 if t1 else 0),
+        ))
+    print(rows, ':r2')
+
+
+def _make_samples(n: int, change_ratio: float) -> tuple:
+    old = {
+        'DCIM/{:03d}/{:02d}/IMG_{:07d}.jpg'.format(
+            i // 10000, i // 100 % 100, i
+        ): 1_700_000_000 + i
+        for i in range(n)
+    }
+    stats_old = {k: [i * 7 % 100_000] for i, k in enumerate(old)}
+    new = dict(old)
+    stats_new = {k: [v[0], 2049, i] for i, (k, v) in enumerate(
+        stats_old.items()
+    )}
+    step = max(int(1 / change_ratio), 1) if change_ratio else n + 1
+    for i, k in enumerate(old):
+        if i % step == 0:
+            new[k] += 60  # modified
+        elif i % step == 1:
+            stats_new[k][0] += 1  # modified in place, mtime kept
+        elif i % step == 2:
+            new.pop(k)  # deleted
+            stats_new.pop(k)
+    for i in range(n // step):
+        k = 'Download/{:07d}.zip'.format(i)  # added
+        new[k] = 1_800_000_000 + i
+        stats_new[k] = [i, 2049, n + i]
+    # snapshots are saved in sorted order.
+    new = dict(sorted(new.items()))
+    stats_new = dict(sorted(stats_new.items()))
+    return old, new, stats_old, stats_new
+
+
+def _per_key_diff(
+    new: T.Nodes, old: T.Nodes, stats_new: T.Stats, stats_old: T.Stats
+) -> T.Changes:
+    # the per-key loop, kept as the baseline of `benchmark`.
+    out = {}
+    for k, time_new in new.items():
+        if k in old:
+            time_old = old[k]
+            if time_new > time_old:
+                out[k] = ('=>', time_new)
+            elif time_new < time_old:
+                pass
+            elif (
+                k in stats_new
+                and k in stats_old
+                and stats_new[k][0] != stats_old[k][0]
+            ):
+                out[k] = ('=>', time_new)
+        else:
+            out[k] = ('+>', time_new)
+    for k, time_old in old.items():
+        if k not in new:
+            out[k] = ('->', time_old)
+    return out
+
+
+if __name__ == '__main__':
+    # pox -m file_sync_pro.snapshot.diff_engine -h
+    _cli.run(benchmark)
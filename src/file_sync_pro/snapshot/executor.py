@@ -0,0 +1,221 @@
+"""
+run sync actions concurrently, with a concurrency limit per side.
+
+transferring many small files is latency bound: each action is several -
+round trips (load, dump, utime...) with the link idle in between. running -
+independent actions at the same time keeps the link busy.
+
+an action is "on side b" if it writes to b ('+>', '=>', '->', '~>'), and "on -
+side a" if it writes to a ('<+', '<=', '<-', '<~'). at most `workers_a` -
+actions run on side a at a time, and `workers_b` on side b.
+
+ordering: actions touching the same path (or a path under a tree-level -
+action's dir, see `api._collapse_subtrees`) run in their planned order, e.g. -
+a move of a key always finishes before a later delete of it. parent dirs -
+are created by each action itself, see `DirMaker`.
+"""
+
+import threading
+import typing as tp
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+
+class T:
+    Action = tp.Tuple[tp.Any, str, int]  # see `api.T.ComposedAction`
+    Key = str
+    Side = tp.Literal['a', 'b']
+
+
+DEFAULT_WORKERS = {'local': 4, 'air': 8}
+
+
+def default_workers(fs: tp.Any) -> int:
+    """
+    params:
+        fs: `lk_utils.fs` or `filesys2.remote.FileSystem`.
+    """
+    url = getattr(fs, 'url', '')
+    if isinstance(url, str) and url.startswith('air://'):
+        return DEFAULT_WORKERS['air']
+    return DEFAULT_WORKERS['local']
+
+
+def side_of(movement: str) -> T.Side:
+    return 'b' if movement.endswith(('>', '>?')) else 'a'
+
+
+def paths_of(
+    key: tp.Union[T.Key, tp.Tuple[T.Key, T.Key]]
+) -> tp.Tuple[T.Key, ...]:
+    return key if isinstance(key, tuple) else (key,)
+
+
+class TransferExecutor:
+    def __init__(self, workers_a: int = 1, workers_b: int = 1) -> None:
+        self.workers = {'a': max(workers_a, 1), 'b': max(workers_b, 1)}
+
+    def run(
+        self,
+        actions: tp.Iterable[T.Action],
+        func: tp.Callable[[T.Key, str, int], None],
+    ) -> tp.Iterator[T.Action]:
+        """
+        call `func(key, movement, time)` for each action, and yield the -
+        actions in the order they are done.
+        if `func` raises, no more actions are started, the running ones are -
+        waited for (and yielded), then the error is raised.
+        """
+        if self.workers['a'] == 1 and self.workers['b'] == 1:
+            for x in actions:
+                func(*x)
+                yield x
+            return
+
+        running: tp.Dict[Future, T.Action] = {}
+        count = {'a': 0, 'b': 0}
+        error = None
+
+        def collect(block: bool) -> tp.Iterator[T.Action]:
+            nonlocal error
+            done, _ = wait(
+                running,
+                timeout=None if block else 0,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                x = running.pop(future)
+                count[side_of(x[1])] -= 1
+                if future.exception() is None:
+                    yield x
+                elif error is None:
+                    error = future.exception()
+
+        with ThreadPoolExecutor(
+            self.workers['a'] + self.workers['b']
+        ) as pool:
+            for x in actions:
+                side = side_of(x[1])
+                paths = paths_of(x[0])
+                # wait for a free slot on this side, and for earlier actions
+                # on the same paths.
+                while error is None and running and (
+                    count[side] >= self.workers[side]
+                    or any(
+                        _overlaps(paths, paths_of(y[0]))
+                        for y in running.values()
+                    )
+                ):
+                    yield from collect(True)
+                if error is not None:
+                    break
+                running[pool.submit(func, *x)] = x
+                count[side] += 1
+                yield from collect(False)
+            while running:
+                yield from collect(True)
+        if error is not None:
+            raise error
+
+
+class ThreadLocalFs:
+    """
+    forward attribute access to a file system owned by the current thread.
+    the creator thread uses `default`, other threads each get one from -
+    `factory` on first use, e.g. `remote.FileSystem.clone` which opens a new -
+    connection. call `close` to close them when done.
+    """
+
+    def __init__(
+        self, default: tp.Any, factory: tp.Callable[[], tp.Any]
+    ) -> None:
+        self._clones = []
+        self._default = default
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._owner = threading.get_ident()
+        self._local = threading.local()
+
+    def __getattr__(self, name: str) -> tp.Any:
+        if threading.get_ident() == self._owner:
+            return getattr(self._default, name)
+        if (fs := getattr(self._local, 'fs', None)) is None:
+            fs = self._local.fs = self._factory()
+            with self._lock:
+                self._clones.append(fs)
+        return getattr(fs, name)
+
+    def close(self) -> None:
+        """
+        close the file systems made by `factory`, `default` is left open.
+        """
+        with self._lock:
+            clones, self._clones = self._clones, []
+        for fs in clones:
+            fs.close()
+
+
+class DirMaker:
+    """
+    make sure parent dirs exist, for concurrent actions on one side.
+    a dir is made at most once. the lock is only held for bookkeeping, not -
+    across the (remote) calls, and a thread waits only for the dir it needs.
+    """
+
+    def __init__(
+        self,
+        exist: tp.Callable[[str], bool],
+        make_dirs: tp.Callable[[str], None],
+        known: tp.Iterable[str] = (),
+    ) -> None:
+        """
+        params:
+            known: dirs known to exist.
+        """
+        self.done = set(known)
+        self._exist = exist
+        self._lock = threading.Lock()
+        self._make_dirs = make_dirs
+        self._pending: tp.Dict[str, threading.Event] = {}
+
+    def ensure(self, dirpath: str) -> None:
+        while True:
+            with self._lock:
+                if dirpath in self.done:
+                    return
+                if (event := self._pending.get(dirpath)) is None:
+                    event = self._pending[dirpath] = threading.Event()
+                    break
+            # another thread is making it, wait and check again.
+            event.wait()
+        try:
+            if not self._exist(dirpath):
+                self._make_dirs(dirpath)
+            with self._lock:
+                self.done.add(dirpath)
+        finally:
+            with self._lock:
+                self._pending.pop(dirpath)
+            event.set()
+
+    def add(self, dirpaths: tp.Iterable[str]) -> None:
+        """
+        mark dirs as existing, e.g. after they are made in bulk.
+        """
+        with self._lock:
+            self.done.update(dirpaths)
+
+
+def _overlaps(x: tp.Tuple[str, ...], y: tp.Tuple[str, ...]) -> bool:
+    for p in x:
+        for q in y:
+            if p == q:
+                return True
+            # a key ending with '/' is a dir, covering all keys under it.
+            if p.endswith('/') and q.startswith(p):
+                return True
+            if q.endswith('/') and p.startswith(q):
+                return True
+    return False
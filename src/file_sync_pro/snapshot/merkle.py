@@ -0,0 +1,201 @@
+"""
+per-directory hashes of a node map (merkle tree).
+
+each directory has a hash of its children: files contribute their name, -
+mtime and size; subdirectories contribute their name and own hash. the hash -
+of root dir (key '') is used as the snapshot version hash.
+
+children hashes are combined by xor, so a directory hash can be updated in -
+place when some of its children change, without listing the others. an -
+update costs O(changed files * depth) instead of O(all files).
+
+two node maps can be diffed by descending only into dirs whose hashes -
+differ, see `changed_keys`.
+"""
+
+import hashlib
+import typing as tp
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class T:
+    DirKey = str  # relpath of a dir, '' for root.
+    Key = str
+    Nodes = tp.Dict[Key, int]
+    Stats = tp.Dict[Key, tp.List[int]]
+    Hashes = tp.Dict[DirKey, str]
+    #   {dir: hex digest, ...}. a dir without files (at any depth) is absent.
+    _Hashes = tp.Dict[DirKey, int]
+
+
+def build_hashes(files: T.Nodes, stats: T.Stats) -> T.Hashes:
+    acc: T._Hashes = {}
+    delta: T._Hashes = defaultdict(int)
+    for k, t in files.items():
+        d, name = split_key(k)
+        delta[d] ^= _file_entry(name, t, stats.get(k))
+    _propagate(acc, delta)
+    return {d: '{:032x}'.format(h) for d, h in acc.items() if h}
+
+
+def update_hashes(
+    files: T.Nodes,
+    stats: T.Stats,
+    old: tp.Optional[tp.Tuple[T.Nodes, T.Stats, T.Hashes]] = None,
+) -> T.Hashes:
+    """
+    params:
+        old: `(files, stats, hashes)` of the last state. if not given, or it -
+            has no hashes, the hashes are built from scratch.
+    """
+    if not old or not old[2]:
+        return build_hashes(files, stats)
+    old_files, old_stats, old_hashes = old
+    acc: T._Hashes = {d: int(h, 16) for d, h in old_hashes.items()}
+    delta: T._Hashes = defaultdict(int)
+    for k in diff_keys(files, stats, old_files, old_stats):
+        d, name = split_key(k)
+        if k in old_files:
+            delta[d] ^= _file_entry(name, old_files[k], old_stats.get(k))
+        if k in files:
+            delta[d] ^= _file_entry(name, files[k], stats.get(k))
+    _propagate(acc, delta)
+    return {d: '{:032x}'.format(h) for d, h in acc.items() if h}
+
+
+def diff_keys(
+    files: T.Nodes, stats: T.Stats, old_files: T.Nodes, old_stats: T.Stats
+) -> tp.Iterator[T.Key]:
+    for k, t in files.items():
+        if old_files.get(k) != t or _size_of(stats, k) != (
+            _size_of(old_stats, k)
+        ):
+            yield k
+    for k in old_files.keys() - files.keys():
+        yield k
+
+
+def changed_keys(
+    files: T.Nodes,
+    old_files: T.Nodes,
+    hashes: T.Hashes,
+    old_hashes: T.Hashes,
+) -> tp.Tuple[tp.List[T.Key], tp.List[T.Key]]:
+    """
+    find the keys that may differ between two node maps, by descending only -
+    into dirs whose hashes differ.
+    
+    returns: (keys from `files`, keys from `old_files`)
+        keys in unchanged dirs are not included.
+    """
+    # node maps are usually saved in sorted order, sorting them again is
+    # cheap.
+    keys = sorted(files)
+    old_keys = sorted(old_files)
+    out = []
+    old_out = []
+    stack = ['']
+    while stack:
+        d = stack.pop()
+        if hashes.get(d) == old_hashes.get(d):
+            continue
+        subdirs = set()
+        for keys_x, out_x in ((keys, out), (old_keys, old_out)):
+            for k, sub in _iter_dir(keys_x, d):
+                if sub is None:
+                    out_x.append(k)
+                else:
+                    subdirs.add(sub)
+        stack.extend(subdirs)
+    return out, old_out
+
+
+def root_hash(hashes: T.Hashes) -> str:
+    return hashes.get('', '0' * 32)
+
+
+def split_key(key: T.Key) -> tp.Tuple[T.DirKey, str]:
+    """
+    e.g.
+        'a/b/c.txt' -> ('a/b', 'c.txt')
+        'a.txt'     -> ('', 'a.txt')
+        'a/b/'      -> ('a/b', '')  # an empty dir marker.
+    """
+    d, _, name = key.rpartition('/')
+    return d, name
+
+
+def _iter_dir(
+    sorted_keys: tp.List[T.Key], d: T.DirKey
+) -> tp.Iterator[tp.Tuple[tp.Optional[T.Key], tp.Optional[T.DirKey]]]:
+    """
+    yield `(key, None)` for direct children of `d`, and `(None, subdir)` for -
+    each subdir. files under a subdir are skipped by bisecting.
+    """
+    prefix = d + '/' if d else ''
+    i = bisect_left(sorted_keys, prefix)
+    n = len(sorted_keys)
+    while i < n:
+        k = sorted_keys[i]
+        if not k.startswith(prefix):
+            break
+        j = k.find('/', len(prefix))
+        if j == -1:
+            yield k, None
+            i += 1
+        else:
+            yield None, k[:j]
+            # '0' is the next char of '/', all keys under `k[:j]/` are before
+            # `k[:j]0`.
+            i = bisect_left(sorted_keys, k[:j] + '0', i)
+
+
+def _propagate(acc: T._Hashes, delta: T._Hashes) -> None:
+    """
+    apply `delta` (xor masks of direct children) to `acc`, and pass the -
+    changes up to the parent dirs, from the deepest level to root.
+    """
+    levels = defaultdict(dict)
+    for d, x in delta.items():
+        if x:
+            levels[_depth(d)][d] = x
+    for depth in range(max(levels, default=-1), -1, -1):
+        for d, x in levels[depth].items():
+            old = acc.get(d, 0)
+            new = old ^ x
+            if new:
+                acc[d] = new
+            else:
+                acc.pop(d, None)
+            if d == '':
+                continue
+            parent, name = split_key(d)
+            mask = _dir_entry(name, old) ^ _dir_entry(name, new)
+            if mask:
+                up = levels[depth - 1]
+                up[parent] = up.get(parent, 0) ^ mask
+
+
+def _depth(d: T.DirKey) -> int:
+    return d.count('/') + 1 if d else 0
+
+
+def _dir_entry(name: str, h: int) -> int:
+    if not h:
+        return 0
+    return _digest('d\0{}\0{:x}'.format(name, h))
+
+
+def _file_entry(name: str, mtime: int, stat: tp.Optional[list]) -> int:
+    return _digest('f\0{}\0{}\0{}'.format(
+        name, mtime, stat[0] if stat else ''
+    ))
+
+
+def _digest(text: str) -> int:
+    return int.from_bytes(hashlib.md5(text.encode()).digest(), 'big')
+
+
+def _size_of(stats: T.Stats, key: T.Key) -> tp.Optional[int]:
+    return stats[key][0] if key in stats else None
@@ -0,0 +1,84 @@
+"""
+stream planned actions into the apply stage.
+
+`PlanStream` runs the planner (a generator of actions, e.g. -
+`api._compare_changelists`) in a background thread, and hands the actions -
+over through a bounded queue. transfers start as soon as the first action is -
+planned, and at most `maxsize` planned actions wait in memory.
+
+only the planned actions are bounded: the inputs of the planner (the node -
+diffs of both sides, see `api.sync_snapshot`) are fully built before the -
+stream starts.
+
+the planner runs once. `total` is given by the caller from a cheap counting -
+pass (see `api._count_actions`), and set to the exact number of actions when -
+planning is done.
+"""
+
+import queue
+import threading
+import typing as tp
+
+
+class T:
+    Action = tp.Tuple[tp.Any, str, int]  # see `api.T.ComposedAction`
+    Planner = tp.Callable[[], tp.Iterable[Action]]
+
+
+_END = object()
+
+
+class PlanStream:
+    def __init__(
+        self,
+        plan: T.Planner,
+        total: tp.Optional[int] = None,
+        maxsize: int = 1000,
+    ) -> None:
+        """
+        params:
+            plan: returns a generator of actions.
+            total: the number of actions counted by the caller, it may be -
+                an upper bound. it is corrected when planning is done.
+            maxsize: the capacity of the queue between planner and consumer.
+        """
+        self.total: tp.Optional[int] = total
+        self._plan = plan
+        self._queue = queue.Queue(maxsize)
+        self._error: tp.Optional[BaseException] = None
+        self._stopped = threading.Event()
+
+    def __iter__(self) -> tp.Iterator[T.Action]:
+        threading.Thread(target=self._produce, daemon=True).start()
+        try:
+            while (x := self._queue.get()) is not _END:
+                yield x
+        finally:
+            # the consumer may stop early (e.g. an exception in transfer),
+            # release the producer thread.
+            self._stopped.set()
+        if self._error:
+            raise self._error
+
+    def _produce(self) -> None:
+        n = 0
+        try:
+            for x in self._plan():
+                if not self._put(x):
+                    return
+                n += 1
+        except BaseException as e:
+            self._error = e
+        else:
+            self.total = n
+            print(':v1', 'planned {} actions'.format(n))
+        self._put(_END)
+
+    def _put(self, x: tp.Any) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(x, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
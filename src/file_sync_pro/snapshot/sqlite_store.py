@@ -0,0 +1,209 @@
+"""
+a snapshot store on sqlite, used for snapshot files ending with ".db".
+
+tables:
+    meta        (name, value): e.g. root.
+    ignores     (idx, pattern)
+    versions    (section, version, journal): one row for 'base' and one for -
+                'current'.
+    nodes       (tree, key, mtime, size, dev, ino): `tree` is one of -
+                'base.files', 'current.files', 'current.dirs'. size, dev and -
+                ino are the stat of a file (see `filesys2.local.make_stat`), -
+                they are null if unknown.
+    hashes      (section, dir, digest): per-directory hashes, see -
+                `merkle.py`.
+
+`dump` compares with the stored rows and only writes the changed ones, so -
+locking a snapshot after syncing 3 files no longer rewrites all the rows.
+nodes are indexed by (tree, key), which makes prefix queries (see -
+`find_nodes`) cheap.
+"""
+
+import sqlite3
+import typing as tp
+from contextlib import closing
+
+
+class T:
+    AnyPath = str
+    FullData = tp.Dict[str, tp.Any]  # see `api.T.SnapshotFull`
+    Key = str
+    Row = tp.Tuple[int, tp.Optional[int], tp.Optional[int], tp.Optional[int]]
+    #   (mtime, size, dev, ino)
+    Tree = tp.Literal['base.files', 'current.files', 'current.dirs']
+
+
+_SCHEMA = '''
+create table if not exists meta (
+    name text primary key,
+    value text
+);
+create table if not exists ignores (
+    idx integer primary key,
+    pattern text
+);
+create table if not exists versions (
+    section text primary key,
+    version text,
+    journal text
+);
+create table if not exists nodes (
+    tree text,
+    key text,
+    mtime integer,
+    size integer,
+    dev integer,
+    ino integer,
+    primary key (tree, key)
+) without rowid;
+create table if not exists hashes (
+    section text,
+    dir text,
+    digest text,
+    primary key (section, dir)
+) without rowid;
+'''
+
+
+def load(file: T.AnyPath) -> T.FullData:
+    with closing(_connect(file)) as conn:
+        full_data = {
+            'root': conn.execute(
+                'select value from meta where name = ?', ('root',)
+            ).fetchone()[0],
+            'ignores': [
+                x for (x,) in conn.execute(
+                    'select pattern from ignores order by idx'
+                )
+            ],
+        }
+        for section, version, journal in conn.execute(
+            'select section, version, journal from versions'
+        ):
+            item = full_data[section] = {'version': version}
+            item['files'], item['stats'] = _load_tree(
+                conn, section + '.files'
+            )
+            if section == 'current':
+                item['dirs'], _ = _load_tree(conn, 'current.dirs')
+            if hashes := dict(conn.execute(
+                'select dir, digest from hashes where section = ?',
+                (section,),
+            )):
+                item['hashes'] = hashes
+            if journal is not None:
+                item['journal'] = journal
+    return full_data
+
+
+def dump(full_data: T.FullData, file: T.AnyPath) -> None:
+    with closing(_connect(file)) as conn, conn:
+        conn.execute(
+            'insert or replace into meta values (?, ?)',
+            ('root', full_data['root']),
+        )
+        conn.execute('delete from ignores')
+        conn.executemany(
+            'insert into ignores values (?, ?)',
+            enumerate(full_data.get('ignores', ())),
+        )
+        for section in ('base', 'current'):
+            item = full_data[section]
+            conn.execute(
+                'insert or replace into versions values (?, ?, ?)',
+                (section, item['version'], item.get('journal')),
+            )
+            _dump_tree(
+                conn, section + '.files', item['files'], item.get('stats', {})
+            )
+            if section == 'current':
+                _dump_tree(conn, 'current.dirs', item.get('dirs', {}), {})
+            _dump_hashes(conn, section, item.get('hashes', {}))
+
+
+def find_nodes(
+    file: T.AnyPath, prefix: str, tree: T.Tree = 'current.files'
+) -> tp.Dict[T.Key, int]:
+    """
+    get nodes under a dir, e.g. `find_nodes(snap_file, 'DCIM/')`.
+    this uses the (tree, key) index instead of loading the whole snapshot.
+    """
+    with closing(_connect(file)) as conn:
+        return dict(conn.execute(
+            'select key, mtime from nodes '
+            'where tree = ? and key >= ? and key < ?',
+            (tree, prefix, prefix + '\U0010ffff'),
+        ))
+
+
+def _connect(file: T.AnyPath) -> sqlite3.Connection:
+    conn = sqlite3.connect(file)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _load_tree(conn: sqlite3.Connection, tree: T.Tree) -> tuple:
+    nodes = {}
+    stats = {}
+    for key, mtime, size, dev, ino in conn.execute(
+        'select key, mtime, size, dev, ino from nodes where tree = ? '
+        'order by key',
+        (tree,),
+    ):
+        nodes[key] = mtime
+        if size is not None:
+            stats[key] = [size] if ino is None else [size, dev, ino]
+    return nodes, stats
+
+
+def _dump_tree(
+    conn: sqlite3.Connection,
+    tree: T.Tree,
+    nodes: tp.Dict[T.Key, int],
+    stats: tp.Dict[T.Key, tp.List[int]],
+) -> None:
+    old: tp.Dict[T.Key, T.Row] = {
+        r[0]: r[1:] for r in conn.execute(
+            'select key, mtime, size, dev, ino from nodes where tree = ?',
+            (tree,),
+        )
+    }
+    new: tp.Dict[T.Key, T.Row] = {}
+    for key, mtime in nodes.items():
+        s = stats.get(key, ())
+        new[key] = (
+            mtime,
+            s[0] if s else None,
+            s[1] if len(s) > 1 else None,
+            s[2] if len(s) > 2 else None,
+        )
+    conn.executemany(
+        'delete from nodes where tree = ? and key = ?',
+        ((tree, k) for k in old.keys() - new.keys()),
+    )
+    conn.executemany(
+        'insert or replace into nodes values (?, ?, ?, ?, ?, ?)',
+        (
+            (tree, k, *row) for k, row in new.items()
+            if old.get(k) != row
+        ),
+    )
+
+
+def _dump_hashes(
+    conn: sqlite3.Connection, section: str, hashes: tp.Dict[str, str]
+) -> None:
+    old = dict(conn.execute(
+        'select dir, digest from hashes where section = ?', (section,)
+    ))
+    conn.executemany(
+        'delete from hashes where section = ? and dir = ?',
+        ((section, d) for d in old.keys() - hashes.keys()),
+    )
+    conn.executemany(
+        'insert or replace into hashes values (?, ?, ?)',
+        (
+            (section, d, h) for d, h in hashes.items()
+            if old.get(d) != h
+        ),
+    )
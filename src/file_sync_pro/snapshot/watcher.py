@@ -0,0 +1,83 @@
+"""
+keep the "current" item of a snapshot file up to date by watching its root.
+
+this requires `watchdog` (inotify on linux/termux, ReadDirectoryChangesW on -
+windows):
+    pip install watchdog
+"""
+
+from lk_utils import fs as fs0
+from time import sleep
+from .api import T
+from .api import _make_hashes  # noqa
+from .api import _make_version  # noqa
+from .api import update_snapshot
+from .codec import dump_snapshot
+from .codec import load_snapshot
+from ..filesys2 import FileSystem
+from ..filesys2.events import EventFolder
+
+
+def watch_snapshot(snap_file: T.AnyPath, flush_interval: float = 5.0) -> None:
+    """
+    watch the (local) root of a snapshot, fold file system events into its -
+    "current" node map, and flush the map to snapshot file in batches.
+    with the watcher running, `sync_snapshot` needs no rescan on this side.
+    
+    params:
+        flush_interval (-i): seconds between two flushes. a flush happens -
+            only if something changed.
+    """
+    from watchdog.observers import Observer
+    
+    update_snapshot(snap_file)
+    full_data = load_snapshot(snap_file)
+    fs1 = FileSystem(full_data['root'])
+    assert not fs1.is_remote, 'only a local root can be watched'
+    
+    folder = EventFolder(
+        fs1.root,
+        full_data['current']['files'],
+        full_data['current'].get('dirs', {}),
+        full_data.get('ignores', ()),
+        fs0.abspath(snap_file),
+        full_data['current'].get('stats', {}),
+    )
+    del full_data
+    
+    observer = Observer()
+    observer.schedule(folder, fs1.root, recursive=True)
+    observer.start()
+    print(':v2', 'watching "{}"'.format(fs1.root))
+    try:
+        while True:
+            sleep(flush_interval)
+            if folder.dirty:
+                _flush(folder, snap_file)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+        if folder.dirty:
+            _flush(folder, snap_file)
+
+
+def _flush(folder: EventFolder, snap_file: T.AnyPath) -> None:
+    with folder.lock:
+        files = dict(sorted(folder.files.items()))
+        stats = folder.stats.copy()
+        dirs = folder.dirs.copy()
+        folder.dirty = False
+    # reload the file, since `sync_snapshot` may have locked a new base.
+    full_data = load_snapshot(snap_file)
+    hashes = _make_hashes(files, stats, full_data['current'])
+    full_data['current'] = {
+        'version': _make_version(hashes),
+        'files': files,
+        'stats': stats,
+        'dirs': dirs,
+        'hashes': hashes,
+    }
+    dump_snapshot(full_data, snap_file)
+    print(':v2i', 'flushed {} files'.format(len(files)))
@@ -116,8 +116,8 @@ def main(host_name: str = 'likianta-rider-r2') -> None:
             format_func=lambda x: x[0],
         )[1]
 
-    l_path = fs.load(l_snap_file)['root']
-    r_path = fs.load(r_snap_file)['root']
+    l_path = snap_api.load_snapshot(l_snap_file)['root']
+    r_path = snap_api.load_snapshot(r_snap_file)['root']
     st.info(
         """
         - :{}[{} **{}** ({})]
@@ -141,11 +141,15 @@ def main(host_name: str = 'likianta-rider-r2') -> None:
 
     with place1:
         if st.button('Update left'):
-            snap_api.update_snapshot(l_snap_file, l_addr)
-            st.toast(':green[Left snapshot updated.]')
+            ratio = snap_api.update_snapshot(l_snap_file, l_addr)
+            st.toast(
+                ':green[Left snapshot updated ({:.0%} reused).]'.format(ratio)
+            )
         if st.button('Update right'):
-            snap_api.update_snapshot(r_snap_file, r_addr)
-            st.toast(':green[Right snapshot updated.]')
+            ratio = snap_api.update_snapshot(r_snap_file, r_addr)
+            st.toast(
+                ':green[Right snapshot updated ({:.0%} reused).]'.format(ratio)
+            )
         do_sync = st.button('Sync', type='primary')
         do_merge = st.button('Merge')
         kwargs = {}
@@ -191,6 +195,8 @@ def _preview_changes(changes: tp.Iterable[snap_api.T.ComposedAction]) -> None:
     i = 0
     table = [('Index', 'Left', 'Action', 'Right')]
     for k, m, _ in changes:
+        if m == '==':
+            continue
         i += 1
         colored_key = ':{}[{}]'.format(
             'yellow'